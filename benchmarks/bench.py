@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+"""
+srcgen benchmarks. Usage::
+
+    python benchmarks/bench.py                        # run everything
+    python benchmarks/bench.py -k html -k css         # only benchmarks whose name contains html/css
+    python benchmarks/bench.py --save baseline.json   # save the results as a baseline
+    python benchmarks/bench.py --compare baseline.json
+
+Every benchmark is timed ``--repeat`` times (the best run is reported) after which it's run once
+more under ``tracemalloc`` to measure its peak memory. Setup work (e.g., building the module that
+a render benchmark renders) is not part of the measurement. ``--compare`` reports the time ratio
+against the baseline, and exits with a non-zero status if any benchmark got slower than
+``--tolerance``
+"""
+from __future__ import print_function, with_statement
+import os
+import sys
+import gc
+import gzip
+import json
+import platform
+import argparse
+import tracemalloc
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from srcgen.python import PythonModule, CythonModule, E as PyE
+from srcgen.c import CModule, HModule, E as CE
+from srcgen.base import enable_interning, disable_interning
+from srcgen.js import JS
+from srcgen.html import HtmlDocument, CSS, xml_escape, xml_escape_many
+
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """Registers a benchmark: ``func(scale)`` does the setup and returns a callable that does the
+    measured work. The callable returns the text it produced, a module/document (which is
+    rendered, outside of the measurement, to count its output), or a ``(lines, bytes)`` tuple"""
+    BENCHMARKS.append(func)
+    return func
+
+def output_stats(result):
+    if isinstance(result, tuple):
+        return result
+    if not isinstance(result, str):
+        result = result.render()
+    return result.count("\n"), len(result)
+
+#===================================================================================================
+# Modules
+#===================================================================================================
+def build_python(m, count):
+    m.import_("sys")
+    for i in range(count):
+        with m.class_("Class%d" % (i,)):
+            with m.method("__init__", "a", "b"):
+                m.stmt("self.a = a")
+                m.stmt("self.b = b")
+            with m.method("compute", "x"):
+                with m.for_("i", "range(x)"):
+                    with m.if_("i % {0} == 0", i + 1):
+                        m.comment("found one")
+                        m.return_("i * self.a")
+                    with m.else_():
+                        m.continue_()
+                m.return_("self.b")
+    return m
+
+@benchmark
+def python_build(scale):
+    return lambda: build_python(PythonModule(), 2000 * scale)
+
+@benchmark
+def python_render(scale):
+    m = build_python(PythonModule(), 2000 * scale)
+    return lambda: m.render()
+
+@benchmark
+def python_render_compact(scale):
+    m = build_python(PythonModule(compact = True), 2000 * scale)
+    return lambda: m.render()
+
+@benchmark
+def python_render_deep(scale):
+    m = PythonModule(indentation = " ")
+    ctxs = []
+    for i in range(2000 * scale):
+        ctx = m.while_("x > {0}", i)
+        ctx.__enter__()
+        ctxs.append(ctx)
+        m.stmt("x -= 1")
+    while ctxs:
+        ctxs.pop().__exit__(None, None, None)
+    return lambda: m.render()
+
+@benchmark
+def cython_build_render(scale):
+    def run():
+        m = CythonModule()
+        for i in range(1000 * scale):
+            with m.cdef.class_("Class%d" % (i,)):
+                m.cdef.stmt("int x")
+                with m.cdef("int get", "self"):
+                    m.return_("self.x")
+                with m.get_property("value"):
+                    m.return_("self.x * 2")
+        return m.render()
+    return run
+
+def build_c(m, count):
+    m.include("<stdio.h>")
+    for i in range(count):
+        m.comment("function %d" % (i,))
+        with m.func("int", "func%d" % (i,), "int x", "int y"):
+            with m.for_("int i = 0", "i < x", "i++"):
+                with m.switch("i % 4"):
+                    for j in range(4):
+                        with m.case(j):
+                            m.stmt("y += %d" % (j,))
+                            m.break_()
+            with m.if_(CE("y") > i):
+                m.return_(CE("y") - i)
+            m.return_("y")
+    return m
+
+@benchmark
+def c_build_render(scale):
+    return lambda: build_c(CModule(), 1500 * scale).render()
+
+@benchmark
+def h_render(scale):
+    m = HModule("BENCH_H")
+    for i in range(5000 * scale):
+        with m.struct("s%d" % (i,)):
+            m.stmt("int a")
+            m.stmt("double b")
+        m.stmt("int func%d(struct s%d * s)" % (i, i))
+    return lambda: m.render()
+
+@benchmark
+def js_build_render(scale):
+    def run():
+        m = JS()
+        for i in range(2000 * scale):
+            with m.func("f%d" % (i,), "a", "b"):
+                m.var("x", [1, 2, i])
+                with m.if_("a > b"):
+                    m.return_("a")
+                with m.else_():
+                    m.return_("x[0]")
+        return m.render()
+    return run
+
+#===================================================================================================
+# HTML
+#===================================================================================================
+def build_html(rows):
+    doc = HtmlDocument()
+    with doc.head():
+        doc.title("benchmark")
+    with doc.body():
+        with doc.table(class_ = "results"):
+            for i in range(rows):
+                with doc.tr(data_row = i):
+                    doc.td("row %d" % (i,))
+                    doc.td("a < b & c", class_ = "value")
+                    with doc.td():
+                        doc.a("link", href = "/row?id=%d&x=1" % (i,))
+    return doc
+
+@benchmark
+def html_build(scale):
+    return lambda: build_html(5000 * scale)
+
+@benchmark
+def html_element_memory(scale):
+    # lines = elements, so "peak B/line" is the memory taken by each element
+    count = 20000 * scale
+    def run():
+        doc = HtmlDocument()
+        with doc.body():
+            for i in range(count // 4):
+                with doc.div():
+                    doc.span()
+                    doc.span(class_ = "x")
+                    doc.br()
+        return count, 0
+    return run
+
+@benchmark
+def html_render(scale):
+    doc = build_html(5000 * scale)
+    return lambda: doc.render()
+
+@benchmark
+def html_render_frozen(scale):
+    doc = build_html(5000 * scale)
+    doc.freeze_attrs()
+    return lambda: doc.render()
+
+_LEGACY_MAPPING = {"&" : "&amp;", "'" : "&apos;", '"' : "&quot;", "<" : "&lt;", ">" : "&gt;"}
+def legacy_xml_escape(text):
+    """The original, per-character implementation, for comparison"""
+    if text is None:
+        return ""
+    return "".join(_LEGACY_MAPPING.get(ch, ch) for ch in str(text))
+
+def escape_texts(scale):
+    texts = ["plain text without anything special %d" % (i,) for i in range(50000 * scale)]
+    texts.extend("<tag attr='%d'>a & b</tag>" % (i,) for i in range(50000 * scale))
+    texts.append("a long paragraph & <some> 'markup' " * 20000 * scale)
+    return texts
+
+def escape_each(escape, texts):
+    def run():
+        size = 0
+        for t in texts:
+            size += len(escape(t))
+        return len(texts), size
+    return run
+
+@benchmark
+def xml_escape_large(scale):
+    return escape_each(xml_escape, escape_texts(scale))
+
+@benchmark
+def xml_escape_legacy(scale):
+    return escape_each(legacy_xml_escape, escape_texts(scale))
+
+@benchmark
+def xml_escape_bulk(scale):
+    texts = escape_texts(scale)
+    def run():
+        escaped = xml_escape_many(texts)
+        return len(escaped), sum(len(t) for t in escaped)
+    return run
+
+@benchmark
+def css_render(scale):
+    css = CSS()
+    for i in range(200 * scale):
+        with css("div.c%d" % (i,), "section.c%d" % (i,)):
+            css["margin"] = 0
+            with css("a", "a:hover", "a:visited"):
+                css["color"] = "#aabbcc"
+                with css(".foo", ".bar"):
+                    css["background_color"] = "black"
+    def run():
+        lines = list(css.render_html())
+        return len(lines), sum(len(line) for _, _, line in lines)
+    return run
+
+#===================================================================================================
+# Expressions
+#===================================================================================================
+@benchmark
+def python_expressions(scale):
+    def run():
+        total = PyE("x0")
+        for i in range(2000 * scale):
+            total = total + PyE("a")[i] * (PyE("k") // 2) + PyE("f")(i, key = PyE("v").attr)
+        return str(total)
+    return run
+
+@benchmark
+def c_expressions(scale):
+    def run():
+        total = CE("x0")
+        for i in range(2000 * scale):
+            total = (total + CE("a")[i] * CE("k")) << 1 | CE("f")("s", i)
+        return str(total)
+    return run
+
+def build_kernel(count):
+    # the expressions are kept, as a generator that emits them into a module would keep them
+    x, y, k = PyE("x"), PyE("y"), PyE("k")
+    return [(x[i % 64] * k + y[i % 64]) * (x[i % 64] - 1) for i in range(count)]
+
+@benchmark
+def expression_memory(scale):
+    # lines = expressions, so "peak B/line" is the memory taken by each expression
+    count = 100000 * scale
+    def run():
+        build_kernel(count)
+        return count, 0
+    return run
+
+@benchmark
+def expression_memory_interned(scale):
+    count = 100000 * scale
+    def run():
+        enable_interning(PyE)
+        try:
+            build_kernel(count)
+        finally:
+            disable_interning(PyE)
+        return count, 0
+    return run
+
+#===================================================================================================
+# Compression
+#===================================================================================================
+# render-then-compress is what callers had to do before dump()/iter_render() could compress;
+# both sides use zlib's default level, so only the streaming differs
+class ByteCounter(object):
+    def __init__(self):
+        self.size = 0
+    def write(self, data):
+        self.size += len(data)
+
+@benchmark
+def python_gzip_legacy(scale):
+    m = build_python(PythonModule(), 2000 * scale)
+    lines = m.render().count("\n")
+    return lambda: (lines, len(gzip.compress(m.render().encode("utf-8"), compresslevel = 6)))
+
+@benchmark
+def python_gzip_streaming(scale):
+    m = build_python(PythonModule(), 2000 * scale)
+    lines = m.render().count("\n")
+    def run():
+        out = ByteCounter()
+        m.dump(out, compression = "gzip")
+        return lines, out.size
+    return run
+
+@benchmark
+def html_gzip_legacy(scale):
+    doc = build_html(5000 * scale)
+    lines = doc.render().count("\n")
+    return lambda: (lines, len(gzip.compress(doc.render().encode("utf-8"), compresslevel = 6)))
+
+@benchmark
+def html_gzip_streaming(scale):
+    doc = build_html(5000 * scale)
+    lines = doc.render().count("\n")
+    return lambda: (lines, sum(len(data) for data in doc.iter_render(compression = "gzip")))
+
+#===================================================================================================
+# Runner
+#===================================================================================================
+def measure(func, scale, repeat):
+    run = func(scale)
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        t0 = default_timer()
+        result = run()
+        elapsed = default_timer() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    lines, size = output_stats(result)
+    del result
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds" : best,
+        "lines" : lines,
+        "bytes" : size,
+        "lines_per_sec" : lines / best if best else 0.0,
+        "bytes_per_sec" : size / best if best else 0.0,
+        "peak_memory" : peak,
+        "peak_per_line" : peak / float(lines) if lines else 0.0,
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "srcgen benchmarks")
+    parser.add_argument("-k", dest = "filters", action = "append", default = [],
+        help = "only run benchmarks whose name contains this string (may be repeated)")
+    parser.add_argument("--scale", type = int, default = 1, help = "problem size multiplier")
+    parser.add_argument("--repeat", type = int, default = 5, help = "timed runs per benchmark")
+    parser.add_argument("--save", metavar = "FILE", help = "save the results as JSON")
+    parser.add_argument("--compare", metavar = "FILE", help = "compare against saved results")
+    parser.add_argument("--tolerance", type = float, default = 0.1,
+        help = "relative slowdown that counts as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    print("%-26s %10s %14s %14s %12s %12s %9s" % ("benchmark", "seconds", "lines/s", "bytes/s", "peak KB",
+        "peak B/line", "vs base"))
+    for func in BENCHMARKS:
+        name = func.__name__
+        if args.filters and not any(f in name for f in args.filters):
+            continue
+        res = results[name] = measure(func, args.scale, args.repeat)
+        ratio = ""
+        if name in baseline and baseline[name]["seconds"]:
+            r = res["seconds"] / baseline[name]["seconds"]
+            ratio = "%.2fx" % (r,)
+            if r > 1 + args.tolerance:
+                regressions.append(name)
+                ratio += " !"
+        print("%-26s %10.4f %14.0f %14.0f %12.1f %12.1f %9s" % (name, res["seconds"], res["lines_per_sec"],
+            res["bytes_per_sec"], res["peak_memory"] / 1024.0, res["peak_per_line"], ratio))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python" : platform.python_version(), "scale" : args.scale, "results" : results},
+                f, indent = 2, sort_keys = True)
+    if regressions:
+        print("regressions: %s" % (", ".join(regressions),))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,41 +1,389 @@
 from __future__ import with_statement
+import sys
+import weakref
+from array import array
+from contextlib import contextmanager
+from six.moves import intern
+from srcgen.output import dump_chunks, encode_chunks, infer_compression
+from srcgen.stats import Instrumented
 
 
-class BaseModule(object):
-    def __init__(self, name = None, line_width = 80, indentation = "    "):
+# expressions up to this size are joined into a string right away (see BaseE)
+_FLATTEN_SIZE = 128
+_new = object.__new__
+
+def _intern(line):
+    return intern(line) if type(line) is str else line
+
+class LineStore(object):
+    """
+    A compact alternative to the nested lists that normally hold a module's lines: all lines
+    are kept (interned) in a single flat list, with a parallel ``array('H')`` of their
+    indentation levels. It supports the (small) subset of the list interface that modules use
+    on ``_curr``
+    """
+    __slots__ = ["lines", "levels", "level"]
+    def __init__(self):
+        self.lines = []
+        self.levels = array("H")
+        self.level = 0
+    def __len__(self):
+        return len(self.lines)
+    def __bool__(self):
+        return bool(self.lines)
+    __nonzero__ = __bool__
+    def __getitem__(self, index):
+        return self.lines[index]
+    def __setitem__(self, index, line):
+        self.lines[index] = _intern(line)
+    def append(self, line):
+        self.lines.append(_intern(line))
+        self.levels.append(self.level)
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+    def pop(self, index = -1):
+        self.levels.pop(index)
+        return self.lines.pop(index)
+
+class _Suite(list):
+    """A nested suite of a module that caches its rendered text once it's closed"""
+    __slots__ = ["closed", "cache"]
+    def __init__(self):
+        list.__init__(self)
+        self.closed = False
+        self.cache = None
+
+class Fragment(object):
+    """
+    A frozen piece of code, captured by :func:`BaseModule.fragment`, that can be inserted into
+    any number of modules (or places within a module) by :func:`BaseModule.insert`. Insertions 
+    only hold a reference to the fragment; its text is rendered once and re-indented to the 
+    level of each insertion (the re-indented text is cached per level as well)
+    """
+    __slots__ = ["_curr", "_lines", "_texts"]
+    def __init__(self, curr):
+        self._curr = curr
+        self._lines = None
+        self._texts = {}
+    
+    def _render_lines(self, level, indentation):
+        if self._lines is None or self._lines[0] != indentation:
+            self._lines = (indentation, tuple(BaseModule._render(self._curr, 0, indentation, True)))
+        lines = self._lines[1]
+        if level == 0:
+            return lines
+        indent = indentation * level
+        return [indent + line if line else "" for line in lines]
+    
+    def _text(self, level, indentation):
+        key = (level, indentation)
+        try:
+            return self._texts[key]
+        except KeyError:
+            pass
+        lines = self._render_lines(level, indentation)
+        text = self._texts[key] = "\n".join(lines) if lines else None
+        return text
+
+
+class BaseModule(Instrumented):
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__(self, name = None, line_width = 80, indentation = "    ", compact = False, 
+            cache_render = False):
+        if compact and cache_render:
+            raise ValueError("cache_render is not supported by compact modules")
         self._indentation = indentation
         self._name = name
         self._line_width = line_width
-        self._curr = []
+        self._cache_render = cache_render
+        self._curr = LineStore() if compact else []
         self._sep_lines = 0
+        self._stats = None
+        self._temps = 0
     def __str__(self):
         return self.render()
     
     @classmethod
-    def _render(cls, curr, level, indentation):
-        indent = indentation * level
-        for elem in curr:
-            if isinstance(elem, list):
-                for line in cls._render(elem, level + 1, indentation):
-                    yield line
+    def _render(cls, curr, level, indentation, expand = False):
+        # each yielded item is normally a single line, except for fragments and cached suites,
+        # which are yielded as whole blocks of text. ``expand`` turns these into separate lines
+        # as well (and bypasses the cache)
+        if isinstance(curr, LineStore):
+            return cls._render_store(curr, level, indentation, expand)
+        else:
+            return cls._render_tree(curr, level, indentation, expand)
+    
+    @classmethod
+    def _render_store(cls, store, level, indentation, expand):
+        indents = {}
+        for line, lvl in zip(store.lines, store.levels):
+            if isinstance(line, Fragment):
+                if expand:
+                    for l in line._render_lines(level + lvl, indentation):
+                        yield l
+                else:
+                    line = line._text(level + lvl, indentation)
+                    if line is not None:
+                        yield line
+                continue
+            line = str(line)
+            if not line.strip():
+                yield ""
+                continue
+            try:
+                indent = indents[lvl]
+            except KeyError:
+                indent = indents[lvl] = indentation * (level + lvl)
+            yield indent + line
+    
+    @classmethod
+    def _render_tree(cls, curr, level, indentation, expand):
+        # iterative, so that deeply-nested suites neither go through a chain of generators
+        # nor hit the recursion limit
+        indents = [indentation * i for i in range(level + 1)]
+        indent = indents[level]
+        stack = []
+        it = iter(curr)
+        # closed suites can no longer change, so the outermost ones (those inside the chain of
+        # suites that are still open) get their text cached; nested caches are dropped
+        # once they're covered by an enclosing one
+        collected = None
+        collected_suite = None
+        collected_depth = None
+        while True:
+            for elem in it:
+                if isinstance(elem, list):
+                    if not expand and isinstance(elem, _Suite) and elem.closed:
+                        cache = elem.cache
+                        if cache is not None and cache[0] == level + 1 and cache[1] == indentation:
+                            if cache[2] is not None:
+                                if collected is not None:
+                                    collected.append(cache[2])
+                                yield cache[2]
+                            if collected is not None:
+                                elem.cache = None
+                            continue
+                        if collected is None:
+                            collected = []
+                            collected_suite = elem
+                            collected_depth = len(stack) + 1
+                    stack.append(it)
+                    it = iter(elem)
+                    level += 1
+                    if level == len(indents):
+                        indents.append(indents[-1] + indentation)
+                    indent = indents[level]
+                    break
+                if isinstance(elem, Fragment):
+                    if expand:
+                        for line in elem._render_lines(level, indentation):
+                            yield line
+                        continue
+                    line = elem._text(level, indentation)
+                    if line is None:
+                        continue
+                else:
+                    line = str(elem)
+                    line = indent + line if line.strip() else ""
+                if collected is not None:
+                    collected.append(line)
+                yield line
             else:
-                line = str(elem)
-                yield indent + line if line.strip() else ""
+                if not stack:
+                    break
+                if collected is not None and len(stack) == collected_depth:
+                    collected_suite.cache = (level, indentation, "\n".join(collected) if collected else None)
+                    collected = collected_suite = collected_depth = None
+                it = stack.pop()
+                level -= 1
+                indent = indents[level]
+    
+    @classmethod
+    def _walk(cls, curr, level = 0):
+        """Yields ``(level, element)`` for each of the (unrendered) lines in the tree, with the 
+        content of fragments inlined"""
+        if isinstance(curr, LineStore):
+            items = ((level + lvl, elem) for elem, lvl in zip(curr.lines, curr.levels))
+        else:
+            items = cls._walk_tree(curr, level)
+        for lvl, elem in items:
+            if isinstance(elem, Fragment):
+                for item in cls._walk(elem._curr, lvl):
+                    yield item
+            else:
+                yield lvl, elem
+    
+    @classmethod
+    def _walk_tree(cls, curr, level):
+        stack = []
+        it = iter(curr)
+        while True:
+            for elem in it:
+                if isinstance(elem, list):
+                    stack.append(it)
+                    it = iter(elem)
+                    level += 1
+                    break
+                yield level, elem
+            else:
+                if not stack:
+                    break
+                it = stack.pop()
+                level -= 1
+    
+    def iter_chunks(self, chunk_size = None):
+        """Renders the module incrementally, yielding chunks of text of (roughly) ``chunk_size`` 
+        characters each. Joining the chunks gives the same text as :func:`render`"""
+        if self._stats is None:
+            return self._iter_chunks(chunk_size)
+        else:
+            return self._stats._render(self, self._iter_chunks(chunk_size))
+    
+    def _iter_chunks(self, chunk_size):
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        lines = []
+        size = 0
+        sep = ""
+        last = ""
+        for line in self._render(self._curr, 0, self._indentation):
+            lines.append(line)
+            size += len(line) + 1
+            if size >= chunk_size:
+                chunk = sep + "\n".join(lines)
+                if chunk:
+                    yield chunk
+                    last = chunk
+                sep = "\n"
+                lines = []
+                size = 0
+        chunk = sep + "\n".join(lines) if lines else ""
+        if not (chunk or last).endswith("\n"):
+            chunk += "\n"
+        if chunk:
+            yield chunk
+    
     def render(self):
-        text = "\n".join(self._render(self._curr, 0, self._indentation))
-        if not text.endswith("\n"):
-            text += "\n"
-        return text
+        return "".join(self.iter_chunks())
+    
+    def render_to(self, fileobj, chunk_size = None):
+        """Renders the module into the given file object, writing it in chunks (so the whole text 
+        is never held in memory)"""
+        for chunk in self.iter_chunks(chunk_size):
+            fileobj.write(chunk)
         
-    def dump(self, filename_or_fileobj):
+    def dump(self, filename_or_fileobj, only_if_changed = False, compression = "infer"):
         """Renders the module and dumps it to the given file. ``file`` can be either a file name or 
-        a file object"""
-        data = self.render()
+        a file object. If ``only_if_changed`` is given, an existing file is only replaced (atomically) 
+        if its content differs from the rendered one. Returns whether the file has been written.
+        
+        ``compression`` (``"gzip"``, ``"zlib"``, ``"bz2"`` or ``"lzma"``) compresses the text as 
+        it's rendered; by default, it's inferred from the file name's extension (e.g., ``.gz``).
+        A file object must be opened in binary mode if it's given a compression"""
+        if self._stats is not None:
+            return self._stats._dump(self, self._dump, filename_or_fileobj, only_if_changed, compression)
+        else:
+            return self._dump(filename_or_fileobj, only_if_changed, compression)
+    
+    def _dump(self, filename_or_fileobj, only_if_changed, compression):
         if hasattr(filename_or_fileobj, "write"):
-            filename_or_fileobj.write(data)
+            if compression and compression != "infer":
+                for data in encode_chunks(self.iter_chunks(), compression = compression):
+                    filename_or_fileobj.write(data)
+            else:
+                self.render_to(filename_or_fileobj)
+            return True
+        else:
+            if compression == "infer":
+                compression = infer_compression(filename_or_fileobj)
+            return dump_chunks(filename_or_fileobj, self.iter_chunks, only_if_changed, 
+                compression = compression)
+
+    def memory_footprint(self):
+        """Returns the (approximate) number of bytes taken by the module's lines and the 
+        structures holding them; strings that are shared between lines are only counted once"""
+        seen = set()
+        total = 0
+        if isinstance(self._curr, LineStore):
+            total += sys.getsizeof(self._curr) + sys.getsizeof(self._curr.lines) + sys.getsizeof(self._curr.levels)
+            elems = self._curr.lines
         else:
-            with open(filename_or_fileobj, "w") as f:
-                f.write(data)
+            elems = []
+            stack = [self._curr]
+            while stack:
+                lst = stack.pop()
+                total += sys.getsizeof(lst)
+                for elem in lst:
+                    if isinstance(elem, list):
+                        stack.append(elem)
+                    else:
+                        elems.append(elem)
+        for elem in elems:
+            if id(elem) not in seen:
+                seen.add(id(elem))
+                total += sys.getsizeof(elem)
+        return total
+
+    def _structure(self):
+        if isinstance(self._curr, LineStore):
+            levels = self._curr.levels
+            suites = sum(1 for prev, lvl in zip(levels, levels[1:]) if lvl > prev)
+            return suites, max(levels) if levels else 0
+        suites = 0
+        max_depth = 0
+        stack = [(self._curr, 0)]
+        while stack:
+            lst, depth = stack.pop()
+            if depth > max_depth:
+                max_depth = depth
+            for elem in lst:
+                if isinstance(elem, list):
+                    suites += 1
+                    stack.append((elem, depth + 1))
+        return suites, max_depth
+
+    @contextmanager
+    def _indented(self):
+        """Lines appended inside this context go into a nested (indented) suite"""
+        curr = self._curr
+        if isinstance(curr, LineStore):
+            curr.level += 1
+            yield
+            curr.level -= 1
+        else:
+            self._curr = _Suite() if self._cache_render else []
+            curr.append(self._curr)
+            yield
+            if self._cache_render:
+                self._curr.closed = True
+            self._curr = curr
+
+    @contextmanager
+    def fragment(self):
+        """Captures the code generated inside this context into a :class:`Fragment` (instead of
+        adding it to the module). The fragment can be inserted once the context exits ::
+        
+            with m.fragment() as cleanup:
+                m.stmt("free(buf)")
+                m.return_("-1")
+            ...
+            with m.if_("rc < 0"):
+                m.insert(cleanup)
+        """
+        curr = self._curr
+        sep_lines = self._sep_lines
+        self._curr = LineStore() if isinstance(curr, LineStore) else []
+        self._sep_lines = 0
+        yield Fragment(self._curr)
+        self._curr = curr
+        self._sep_lines = sep_lines
+    
+    def insert(self, fragment):
+        """Inserts (a reference to) the given :class:`Fragment` at the current position"""
+        self._curr.append(fragment)
+        self._sep_lines = 0
 
     def sep(self, count = 1):
         if self._sep_lines >= count:
@@ -43,6 +391,11 @@ class BaseModule(object):
         self._curr.extend("" for _ in range(count))
         self._sep_lines += count
     
+    def _temp_names(self, prefix):
+        """Yields names for temporaries, unique within the module"""
+        while True:
+            self._temps += 1
+            yield "%s%d" % (prefix, self._temps - 1)
     def _append(self, line):
         if line.strip():
             self._curr.append(line)
@@ -51,6 +404,19 @@ class BaseModule(object):
             self._curr.append("")
             self._sep_lines += 1
 
+def _split_lines(chunks):
+    """Reassembles a stream of text chunks into lines, just like ``"".join(chunks).splitlines()``"""
+    pending = ""
+    for chunk in chunks:
+        parts = (pending + chunk).splitlines(True)
+        if not parts:
+            continue
+        pending = parts.pop()
+        for part in parts:
+            yield part.splitlines()[0]
+    if pending:
+        yield pending.splitlines()[0]
+
 def R(*args, **kwargs):
     """repr"""
     if args and kwargs:
@@ -67,91 +433,239 @@ def R(*args, **kwargs):
         raise TypeError("Either positional or keyword arguments must be given")
 
 
+def _binary(op, reflected = False):
+    """An operator method of expressions. Short rendered operands (the common case) are formatted
+    right away, without going through BaseE._binop"""
+    fmt = "(%s" + op.replace("%", "%%") + "%s)"
+    if reflected:
+        def operator(self, other):
+            if self._interned is None:
+                rval = self._value
+                lval = other._value if isinstance(other, BaseE) else repr(other)
+                if type(lval) is str and type(rval) is str and len(lval) + len(rval) <= _FLATTEN_SIZE:
+                    expr = _new(type(self))
+                    expr._value = fmt % (lval, rval)
+                    return expr
+            return self._binop(other, op, self)
+    else:
+        def operator(self, other):
+            if self._interned is None:
+                lval = self._value
+                rval = other._value if isinstance(other, BaseE) else repr(other)
+                if type(lval) is str and type(rval) is str and len(lval) + len(rval) <= _FLATTEN_SIZE:
+                    expr = _new(type(self))
+                    expr._value = fmt % (lval, rval)
+                    return expr
+            return self._binop(self, op, other)
+    return operator
+
 class BaseE(object):
     """
-    Expression object
+    Expression object. Operators build a tree of nodes (``_value`` holds a tuple of text pieces 
+    and sub-expressions) that is turned into text only once, when the expression is first
+    rendered, so that building an expression term by term takes linear time.
+    
+    See :func:`enable_interning` for sharing identical expressions
     """
-    __slots__ = ["_value"]
+    __slots__ = ["_value", "__weakref__"]
+    # constant folding (see srcgen.optimize): operator -> function of the operands' values, 
+    # returning None where the result can't be represented as a literal
+    _FOLD_OPS = {}
+    _FOLD_UNARY = {}
+    # common-subexpression elimination: the kinds of nodes that may be assigned to temporaries
+    # (None for all), binary and prefix operators whose results aren't, and whether anything
+    # within a subscript may be
+    _HOISTED_KINDS = None
+    _NOT_HOISTED_OPS = frozenset()
+    _NOT_HOISTED_PREFIX_OPS = frozenset()
+    _HOIST_SUBSCRIPTS = True
+    # the intern table (class, text or pieces) -> expression, if interning is enabled
+    _interned = None
+    _intern_size = 0
+    
     def __init__(self, value):
-        self._value = str(value)
+        if self._interned is None:
+            self._value = str(value)
+    
+    def __reduce__(self):
+        # by text, which is compact and flat, and as the default would call __new__ without a
+        # value (which, with interning, is the shared empty expression)
+        return (_restore, (self.__class__, str(self)))
+    
+    @classmethod
+    def _make(cls, value):
+        table = cls._interned
+        if table is None:
+            expr = object.__new__(cls)
+            expr._value = value
+            return expr
+        key = _intern_key(cls, value)
+        expr = table.get(key)
+        if expr is None:
+            expr = object.__new__(cls)
+            expr._value = value
+            if len(table) < cls._intern_size:
+                table[key] = expr
+        return expr
+    
     def __str__(self):
-        return self._value
-    def __repr__(self):
-        return self._value
-    
-    def __add__(self, other):
-        return self.__class__("(%r + %r)" % (self, other))
-    def __sub__(self, other):
-        return self.__class__("(%r - %r)" % (self, other))
-    def __mul__(self, other):
-        return self.__class__("(%r * %r)" % (self, other))
-    def __truediv__(self, other):
-        return self.__class__("(%r / %r)" % (self, other))
+        value = self._value
+        if not isinstance(value, tuple):
+            return value
+        out = []
+        stack = [iter(value)]
+        while stack:
+            for piece in stack[-1]:
+                if isinstance(piece, BaseE):
+                    if isinstance(piece._value, tuple):
+                        stack.append(iter(piece._value))
+                        break
+                    out.append(piece._value)
+                else:
+                    out.append(piece)
+            else:
+                stack.pop()
+        text = "".join(out)
+        table = self._interned
+        if table is not None:
+            # once the pieces are dropped, the ids in the structural key may be reused
+            key = _intern_key(self.__class__, value)
+            if table.get(key) is self:
+                del table[key]
+            key = (self.__class__, text)
+            if key not in table and len(table) < self._intern_size:
+                table[key] = self
+        self._value = text
+        return text
+    __repr__ = __str__
+    
+    @staticmethod
+    def _fold_literal(text):
+        """Returns the value of the given numeric literal, or None if it shouldn't be folded"""
+        return None
+    
+    def _node(self, *pieces):
+        # small nodes over rendered operands are joined right away: a string is far more compact
+        # than a node, and as it's bounded in size, the copying still adds up to linear time 
+        texts = []
+        size = 0
+        for p in pieces:
+            if isinstance(p, BaseE):
+                p = p._value
+                if isinstance(p, tuple):
+                    break
+            size += len(p)
+            if size > _FLATTEN_SIZE:
+                break
+            texts.append(p)
+        else:
+            return self._make("".join(texts))
+        return self._make(pieces)
+    def _binop(self, lhs, op, rhs):
+        lval = lhs._value if isinstance(lhs, BaseE) else repr(lhs)
+        rval = rhs._value if isinstance(rhs, BaseE) else repr(rhs)
+        # the common case, two short rendered operands, is formatted right away
+        if type(lval) is str and type(rval) is str and len(lval) + len(rval) <= _FLATTEN_SIZE:
+            if self._interned is not None:
+                return self._make("(%s%s%s)" % (lval, op, rval))
+            expr = _new(type(self))
+            expr._value = "(%s%s%s)" % (lval, op, rval)
+            return expr
+        return self._make(("(", lhs if isinstance(lhs, BaseE) else lval, op, 
+            rhs if isinstance(rhs, BaseE) else rval, ")"))
+    
+    __add__ = _binary(" + ")
+    __sub__ = _binary(" - ")
+    __mul__ = _binary(" * ")
+    __truediv__ = _binary(" / ")
     __div__ = __truediv__
-    def __mod__(self, other):
-        return self.__class__("(%r % %r)" % (self, other))
-    def __pow__(self, other):
-        return self.__class__("(%r % %r)" % (self, other))
-    def __or__(self, other):
-        return self.__class__("(%r | %r)" % (self, other))
-    def __and__(self, other):
-        return self.__class__("(%r & %r)" % (self, other))
-    def __xor__(self, other):
-        return self.__class__("(%r ^ %r)" % (self, other))
-    def __lshift__(self, other):
-        return self.__class__("(%r << %r)" % (self, other))
-    def __rshift__(self, other):
-        return self.__class__("(%r >> %r)" % (self, other))
-
-    def __radd__(self, other):
-        return self.__class__("(%r + %r)" % (other, self))
-    def __rsub__(self, other):
-        return self.__class__("(%r - %r)" % (other, self))
-    def __rmul__(self, other):
-        return self.__class__("(%r * %r)" % (other, self))
-    def __rtruediv__(self, other):
-        return self.__class__("(%r / %r)" % (other, self))
+    __mod__ = _binary(" % ")
+    __pow__ = _binary(" ** ")
+    __or__ = _binary(" | ")
+    __and__ = _binary(" & ")
+    __xor__ = _binary(" ^ ")
+    __lshift__ = _binary(" << ")
+    __rshift__ = _binary(" >> ")
+
+    __radd__ = _binary(" + ", reflected = True)
+    __rsub__ = _binary(" - ", reflected = True)
+    __rmul__ = _binary(" * ", reflected = True)
+    __rtruediv__ = _binary(" / ", reflected = True)
     __rdiv__ = __rtruediv__
-    def __rmod__(self, other):
-        return self.__class__("(%r % %r)" % (other, self))
-    def __rpow__(self, other):
-        return self.__class__("(%r % %r)" % (other, self))
-    def __ror__(self, other):
-        return self.__class__("(%r or %r)" % (other, self))
-    def __rand__(self, other):
-        return self.__class__("(%r and %r)" % (other, self))
-    def __rxor__(self, other):
-        return self.__class__("(%r ^ %r)" % (other, self))
-    def __rlshift__(self, other):
-        return self.__class__("(%r << %r)" % (other, self))
-    def __rrshift__(self, other):
-        return self.__class__("(%r >> %r)" % (other, self))
-    
-    def __gt__(self, other):
-        return self.__class__("(%r > %r)" % (self, other))
-    def __ge__(self, other):
-        return self.__class__("(%r >= %r)" % (self, other))
-    def __lt__(self, other):
-        return self.__class__("(%r < %r)" % (self, other))
-    def __le__(self, other):
-        return self.__class__("(%r <= %r)" % (self, other))
-    def __eq__(self, other):
-        return self.__class__("(%r == %r)" % (self, other))
-    def __ne__(self, other):
-        return self.__class__("(%r != %r)" % (self, other))
+    __rmod__ = _binary(" % ", reflected = True)
+    __rpow__ = _binary(" ** ", reflected = True)
+    __ror__ = _binary(" or ", reflected = True)
+    __rand__ = _binary(" and ", reflected = True)
+    __rxor__ = _binary(" ^ ", reflected = True)
+    __rlshift__ = _binary(" << ", reflected = True)
+    __rrshift__ = _binary(" >> ", reflected = True)
+    
+    __gt__ = _binary(" > ")
+    __ge__ = _binary(" >= ")
+    __lt__ = _binary(" < ")
+    __le__ = _binary(" <= ")
+    __eq__ = _binary(" == ")
+    __ne__ = _binary(" != ")
     
     def __neg__(self):
-        return self.__class__("-%r" % (self,))
+        return self._node("-", self)
     def __pos__(self):
-        return self.__class__("+%r" % (self,))
+        return self._node("+", self)
     def __inv__(self):
-        return self.__class__("~%r" % (self,))
+        return self._node("~", self)
     __invert__ = __inv__
     
     def __getitem__(self, key):
-        return self.__class__("%r[%r]" % (self, key))
+        value = self._value
+        if isinstance(key, BaseE):
+            kval = key._value
+        else:
+            kval = key = repr(key)
+        if type(value) is str and type(kval) is str and len(value) + len(kval) <= _FLATTEN_SIZE:
+            if self._interned is not None:
+                return self._make("%s[%s]" % (value, kval))
+            expr = _new(type(self))
+            expr._value = "%s[%s]" % (value, kval)
+            return expr
+        return self._node(self, "[", key, "]")
     def __getattr__(self, name):
-        return self.__class__("%r.%s" % (self, name))
+        if name == "_value" or (name.startswith("__") and name.endswith("__")):
+            # special names (and ``_value`` before it's set, e.g., when unpickling) aren't expressions
+            raise AttributeError(name)
+        value = self._value
+        if type(value) is str and len(value) + len(name) < _FLATTEN_SIZE:
+            return self._make("%s.%s" % (value, name))
+        return self._node(self, "." + name)
+
+def _interning_new(cls, *args):
+    if cls._interned is None or not args:
+        return object.__new__(cls)
+    return cls._make(str(args[0]))
+
+def _restore(cls, text):
+    return cls._make(text)
+
+def enable_interning(cls, max_size = 1 << 20):
+    """Makes the given expression class (and its subclasses) share structurally identical
+    expressions, e.g., ``E("x")[0] is E("x")[0]``. Expressions are kept in a weak-value table of
+    up to ``max_size`` entries, so the table itself doesn't keep them alive. Building expressions
+    takes several times as long (about 4-6 times, in the benchmarks), as most intermediate ones
+    are short-lived and each goes in and out of the table"""
+    cls._interned = weakref.WeakValueDictionary()
+    cls._intern_size = max_size
+    cls.__new__ = staticmethod(_interning_new)
+
+def disable_interning(cls):
+    cls._interned = None
 
+def _intern_key(cls, value):
+    if isinstance(value, tuple):
+        # sub-expressions are identified by their id (they're interned themselves, and kept alive
+        # by the node); text pieces can't be confused with ids
+        return (cls,) + tuple(id(p) if isinstance(p, BaseE) else p for p in value)
+    return (cls, value)
 
+def _operand(obj):
+    # expressions are kept as nodes; anything else is rendered right away, as it may change
+    return obj if isinstance(obj, BaseE) else repr(obj)
 
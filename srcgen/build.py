@@ -0,0 +1,244 @@
+"""
+Building generated code into binaries (Cython extensions and shared libraries), cached by a
+hash of everything that goes into them (the rendered sources, the flags and the tool versions),
+so that unchanged code is never compiled again. Cache directories are shared safely between
+processes: artifacts are built in a private temporary directory and then moved into place
+atomically
+"""
+import os
+import sys
+import ctypes
+import shutil
+import subprocess
+import hashlib
+import tempfile
+import sysconfig
+import importlib.util
+import importlib.machinery
+import six
+from srcgen.pycache import _makedirs
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
+
+class BuildError(Exception):
+    """Raised when the compiler fails; the message includes its output"""
+
+
+def default_cache_dir():
+    """The cache directory used when none is given: ``$SRCGEN_CACHE_DIR``, or ``~/.cache/srcgen``"""
+    return os.environ.get("SRCGEN_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "srcgen")
+
+def _digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode("utf-8")
+        # length-prefixed, so that the parts' boundaries are part of the hash
+        h.update(b"%d:" % (len(part),))
+        h.update(part)
+    return h.hexdigest()
+
+def _text(module):
+    return module if isinstance(module, six.string_types) else module.render()
+
+def _run(func, args_list, workers):
+    """Calls ``func`` on each of the argument tuples, in a pool of ``workers`` processes when
+    there's more than one call (see :class:`Project <srcgen.project.Project>`)"""
+    if workers is None:
+        # cpu_count() returns None if the number can't be determined
+        workers = (os.cpu_count() if hasattr(os, "cpu_count") else None) or 1
+    if ProcessPoolExecutor is None or workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    with ProcessPoolExecutor(min(workers, len(args_list))) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+
+#
+# Cython
+#
+_CYTHON_OPTIONS = ("include_dirs", "library_dirs", "libraries", "extra_compile_args", "extra_link_args",
+    "define_macros", "language")
+
+def _build_cython(name, pyx, pxds, path, options, directives):
+    from Cython.Build import cythonize
+    from setuptools import Extension
+    from setuptools.dist import Distribution
+
+    cache_dir = os.path.dirname(os.path.dirname(path))
+    tmpdir = tempfile.mkdtemp(prefix = ".build-", dir = cache_dir)
+    try:
+        pyx_filename = os.path.join(tmpdir, name.rpartition(".")[2] + ".pyx")
+        with open(pyx_filename, "w") as f:
+            f.write(pyx)
+        for pxd_name, text in pxds:
+            with open(os.path.join(tmpdir, pxd_name + ".pxd"), "w") as f:
+                f.write(text)
+        options = dict((k, list(v) if isinstance(v, tuple) else v) for k, v in options)
+        options["include_dirs"] = [tmpdir] + list(options.get("include_dirs", ()))
+        ext = Extension(name, [pyx_filename], **options)
+        dist = Distribution({"name" : name, "ext_modules" : cythonize([ext], quiet = True,
+            compiler_directives = dict(directives), build_dir = tmpdir)})
+        cmd = dist.get_command_obj("build_ext")
+        cmd.build_lib = cmd.build_temp = tmpdir
+        cmd.ensure_finalized()
+        cmd.run()
+        _makedirs(os.path.dirname(path))
+        os.replace(cmd.get_ext_fullpath(name), path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+    return path
+
+def _load_extension(name, path):
+    module = sys.modules.get(name)
+    if module is not None and getattr(module, "__file__", None) == path:
+        return module
+    loader = importlib.machinery.ExtensionFileLoader(name, path)
+    spec = importlib.util.spec_from_file_location(name, path, loader = loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+def build_cython(extensions, cache_dir = None, workers = None, directives = None, **options):
+    """
+    Cythonizes and compiles the given extensions, returning the imported extension modules (in
+    the same order). Each extension is a ``(name, pyx)`` or ``(name, pyx, pxds)`` tuple, where
+    ``pyx`` is a :class:`CythonModule <srcgen.python.CythonModule>` (or its text) and ``pxds``
+    maps the names of the ``.pxd`` files it uses (e.g., its own name) to modules as well.
+
+    Extensions are built in ``cache_dir`` (see :func:`default_cache_dir`), keyed by a hash of
+    their sources, the Cython ``directives``, the compiler options (``include_dirs``,
+    ``library_dirs``, ``libraries``, ``extra_compile_args``, ``extra_link_args``,
+    ``define_macros`` and ``language``, as in ``setuptools.Extension``) and the Cython and Python
+    versions; an extension is built only if it's not there already. Missing extensions are
+    built in parallel, by a pool of ``workers`` processes (``None`` means one per CPU)
+    """
+    import Cython
+    unknown = set(options) - set(_CYTHON_OPTIONS)
+    if unknown:
+        raise TypeError("unknown options: %s" % (", ".join(sorted(unknown)),))
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    options = sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in options.items())
+    directives = sorted((directives or {}).items())
+    ext_suffix = sysconfig.get_config_var("EXT_SUFFIX")
+
+    names = []
+    paths = []
+    missing = []
+    for ext in extensions:
+        name, pyx, pxds = ext if len(ext) == 3 else ext + ({},)
+        pyx = _text(pyx)
+        pxds = sorted((pxd_name, _text(pxd)) for pxd_name, pxd in pxds.items())
+        key = _digest(name, pyx, pxds, options, directives, Cython.__version__, sys.version, ext_suffix)
+        path = os.path.join(cache_dir, "cython", key[:32], name.rpartition(".")[2] + ext_suffix)
+        names.append(name)
+        paths.append(path)
+        if not os.path.isfile(path):
+            missing.append((name, pyx, pxds, path, options, directives))
+    if missing:
+        _makedirs(os.path.join(cache_dir, "cython"))
+        _run(_build_cython, missing, workers)
+    return [_load_extension(name, path) for name, path in zip(names, paths)]
+
+
+#
+# C
+#
+_compiler_ids = {}
+
+def _compiler_id(compiler):
+    """The compiler's path and version, which are part of the cache keys"""
+    try:
+        return _compiler_ids[compiler]
+    except KeyError:
+        pass
+    try:
+        version = subprocess.check_output([compiler, "--version"], stderr = subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise BuildError("can't run %r: %s" % (compiler, ex))
+    _compiler_ids[compiler] = res = (shutil.which(compiler) or compiler, version)
+    return res
+
+def _call(cmdline):
+    proc = subprocess.Popen(cmdline, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    output = proc.communicate()[0].decode("utf-8", "replace")
+    if proc.returncode != 0:
+        raise BuildError("%s failed (%d):\n%s" % (" ".join(cmdline), proc.returncode, output))
+
+def _compile_object(cmdline, tmp_path, path):
+    _call(cmdline + ["-o", tmp_path])
+    os.replace(tmp_path, path)
+
+def compile_library(sources, headers = None, name = "srcgen", cache_dir = None, compiler = None, 
+        cflags = ("-O2",), ldflags = (), libraries = (), workers = None):
+    """
+    Compiles the given C modules into a shared library, returning its path (e.g., for 
+    ``cffi.FFI.dlopen``). ``sources`` maps the file names of the translation units to
+    :class:`CModule <srcgen.c.CModule>` objects (or their text), and ``headers`` maps the file
+    names of the headers they include (as ``"name.h"``) to modules as well.
+
+    The object files and the library are kept in ``cache_dir`` (see :func:`default_cache_dir`),
+    keyed by a hash of the sources, all the headers, the compiler's version and the flags, so
+    only translation units that have changed are compiled again, and an unchanged library is
+    neither compiled nor linked. Translation units are compiled in parallel, by up to ``workers``
+    compiler processes (``None`` means one per CPU). ``compiler`` defaults to ``$CC``, or 
+    ``cc``; ``libraries`` are linked with ``-l``. System headers aren't part of the hash
+    """
+    if compiler is None:
+        compiler = os.environ.get("CC", "cc")
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if workers is None:
+        workers = (os.cpu_count() if hasattr(os, "cpu_count") else None) or 1
+    compiler_id = _compiler_id(compiler)
+    sources = sorted((fn, _text(mod)) for fn, mod in sources.items())
+    headers = sorted((fn, _text(mod)) for fn, mod in (headers or {}).items())
+    cflags = list(cflags) + ["-fPIC"]
+    ldflags = list(ldflags) + ["-l" + lib for lib in libraries]
+
+    objects = []
+    for fn, text in sources:
+        key = _digest(compiler_id, cflags, text, headers)
+        objects.append((fn, text, os.path.join(cache_dir, "c", "obj", key[:32] + ".o")))
+    key = _digest(compiler_id, ldflags, name, [path for _, _, path in objects])
+    path = os.path.join(cache_dir, "c", key[:32], "lib%s.so" % (name,))
+    if os.path.isfile(path):
+        return path
+    
+    _makedirs(os.path.join(cache_dir, "c", "obj"))
+    _makedirs(os.path.dirname(path))
+    tmpdir = tempfile.mkdtemp(prefix = ".build-", dir = os.path.join(cache_dir, "c"))
+    try:
+        for fn, text in headers + sources:
+            filename = os.path.join(tmpdir, fn)
+            _makedirs(os.path.dirname(filename))
+            with open(filename, "w") as f:
+                f.write(text)
+        jobs = []
+        for i, (fn, _, obj_path) in enumerate(objects):
+            if not os.path.isfile(obj_path):
+                cmdline = [compiler] + cflags + ["-I", tmpdir, "-c", os.path.join(tmpdir, fn)]
+                jobs.append((cmdline, os.path.join(tmpdir, "%d.o" % (i,)), obj_path))
+        if ThreadPoolExecutor is None or workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                _compile_object(*job)
+        else:
+            # the compilers are separate processes, so threads are enough to run them in parallel
+            with ThreadPoolExecutor(min(workers, len(jobs))) as executor:
+                for future in [executor.submit(_compile_object, *job) for job in jobs]:
+                    future.result()
+        tmp_path = os.path.join(tmpdir, "lib%s.so" % (name,))
+        _call([compiler, "-shared", "-o", tmp_path] + [obj_path for _, _, obj_path in objects] + ldflags)
+        os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+    return path
+
+def build_library(sources, headers = None, name = "srcgen", **kwargs):
+    """Compiles the given C modules into a (cached) shared library, as :func:`compile_library`
+    does, and loads it with ``ctypes``"""
+    return ctypes.CDLL(compile_library(sources, headers, name, **kwargs))
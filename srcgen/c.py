@@ -1,5 +1,7 @@
 from __future__ import with_statement
+import re
 from srcgen.base import BaseModule, BaseE, R
+from srcgen.optimize import optimize as _optimize
 from contextlib import contextmanager
 
 
@@ -36,6 +38,18 @@ class CModule(BaseModule):
         if semicolon and text.strip()[0] != "#" and text[-1] not in ";:,{":
             text += ";"
         self._append(text.format(*args) if args else text)
+    def optimize(self, ctype, *exprs, **kwargs):
+        """Folds constants in the given expressions and declares their common sub-expressions as
+        temporaries of type ``ctype`` (named ``prefix`` + a number; ``_t`` by default), returning
+        the optimized expressions. Only arithmetic is hoisted: not comparisons, subscripts,
+        member accesses, pointer operators or anything within a subscript (as they normally
+        aren't of type ``ctype``). See :func:`srcgen.optimize.optimize` for the other keyword 
+        arguments"""
+        prefix = kwargs.pop("prefix", "_t")
+        temps, exprs = _optimize(exprs, self._temp_names(prefix), E, **kwargs)
+        for name, expr in temps:
+            self.stmt("%s %s = %s" % (ctype, name, expr))
+        return exprs
     def break_(self):
         self.stmt("break")
     def continue_(self):
@@ -72,11 +86,7 @@ class CModule(BaseModule):
         if headline[-1] not in "{:":
             headline += " {"
         self._append(headline.format(*args) if args else headline)
-        prev = self._curr
-        self._curr = []
-        prev.append(self._curr)
-        yield
-        self._curr = prev
+        with self._indented(): yield
         if terminator is None:
             self._append("}")
         else:
@@ -148,11 +158,7 @@ class CModule(BaseModule):
         if merge_endif and self._curr and self._curr[-1].startswith("#endif"):
             self._curr.pop(-1)
         self._append(headline)
-        prev = self._curr
-        self._curr = []
-        prev.append(self._curr)
-        yield
-        self._curr = prev
+        with self._indented(): yield
         self.stmt("#endif")
     
     def IF(self, cond):
@@ -167,14 +173,14 @@ class CModule(BaseModule):
         return self._if_suite("#ifndef %s" % (name,), False)
 
 class HModule(CModule):
-    def __init__(self, guard_name):
-        CModule.__init__(self)
+    def __init__(self, guard_name, *args, **kwargs):
+        CModule.__init__(self, *args, **kwargs)
         self._guard_name = guard_name
-    def render(self):
-        text = CModule.render(self)
-        text = "#ifndef %s\n#define %s\n\n" % (self._guard_name, self._guard_name) + text
-        text += "\n#endif /* %s */\n" % (self._guard_name,)
-        return text
+    def _iter_chunks(self, chunk_size):
+        yield "#ifndef %s\n#define %s\n\n" % (self._guard_name, self._guard_name)
+        for chunk in CModule._iter_chunks(self, chunk_size):
+            yield chunk
+        yield "\n#endif /* %s */\n" % (self._guard_name,)
 
 def render_literal(obj):
     """
@@ -185,9 +191,73 @@ def render_literal(obj):
     else:
         return repr(obj)
 
+# constant folding only covers int arithmetic whose result is the same (and still an int literal)
+# in C: no floats (whose literal types and precision differ), no negative division or shifts
+INT_MAX = 2 ** 31 - 1
+_INT_LITERAL = re.compile(r"(?:0|[1-9][0-9]*|0[xX][0-9a-fA-F]+)$")
+
+def _int(value):
+    # -INT_MAX - 1 would be written as -2147483648, which is a long
+    return int(value) if -INT_MAX <= value <= INT_MAX else None
+
+def _non_negative(func):
+    def fold(a, b):
+        return _int(func(a, b)) if a >= 0 and b >= 0 else None
+    return fold
+
+def _fold_shift(func):
+    def fold(a, b):
+        return _int(func(a, b)) if a >= 0 and 0 <= b < 31 else None
+    return fold
+
 class E(BaseE):
+    _FOLD_OPS = {
+        "+" : lambda a, b: _int(a + b),
+        "-" : lambda a, b: _int(a - b),
+        "*" : lambda a, b: _int(a * b),
+        "/" : _non_negative(lambda a, b: a // b),
+        "%" : _non_negative(lambda a, b: a % b),
+        "<<" : _fold_shift(lambda a, b: a << b),
+        ">>" : _fold_shift(lambda a, b: a >> b),
+        "&" : lambda a, b: a & b,
+        "|" : lambda a, b: a | b,
+        "^" : lambda a, b: a ^ b,
+        "<" : lambda a, b: int(a < b),
+        ">" : lambda a, b: int(a > b),
+        "<=" : lambda a, b: int(a <= b),
+        ">=" : lambda a, b: int(a >= b),
+        "==" : lambda a, b: int(a == b),
+        "!=" : lambda a, b: int(a != b),
+        "&&" : lambda a, b: int(bool(a and b)),
+        "||" : lambda a, b: int(bool(a or b)),
+    }
+    _FOLD_UNARY = {
+        "-" : lambda a: _int(-a),
+        "+" : lambda a: a,
+        "~" : lambda a: _int(~a),
+        "!" : lambda a: int(not a),
+    }
+    # temporaries all have the type given to CModule.optimize, which only suits arithmetic: not
+    # the (int) results of comparisons, subscripts, members or pointers
+    _HOISTED_KINDS = frozenset(["bin", "pre"])
+    _NOT_HOISTED_OPS = frozenset(["<", ">", "<=", ">=", "==", "!=", "&&", "||"])
+    _NOT_HOISTED_PREFIX_OPS = frozenset(["!", "*", "&"])
+    _HOIST_SUBSCRIPTS = False
+    
+    @staticmethod
+    def _fold_literal(text):
+        if not _INT_LITERAL.match(text):
+            return None
+        return _int(int(text, 0))
+    
     def __call__(self, *args):
-        return E("%r(%s)" % (self, ", ".join(render_literal(a) for a in args)))
+        pieces = [self, "("]
+        for a in args:
+            pieces.extend((a if isinstance(a, BaseE) else render_literal(a), ", "))
+        if args:
+            pieces.pop()
+        pieces.append(")")
+        return self._node(*pieces)
 
 
 
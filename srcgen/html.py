@@ -1,31 +1,116 @@
 import weakref
 import six
-import itertools
+from six.moves import intern
 from contextlib import contextmanager
 from functools import partial
+from srcgen.output import dump_chunks, compress_chunks, infer_compression
+from srcgen.stats import Instrumented
 
 
 _MAPPING = {"&" : "&amp;", "'" : "&apos;", '"' : "&quot;", "<" : "&lt;", ">" : "&gt;"}
+# "&" must come first. ``in`` + ``str.replace`` turns out to be much faster than ``str.translate``
+# (which is slow when characters map to multi-character strings), and the common case, where
+# there's nothing to escape, costs just five ``in`` scans and returns the string as-is
+_REPLACEMENTS = tuple((ch, _MAPPING[ch]) for ch in "&<>\"'")
+
 def xml_escape(text):
     if text is None:
         return ""
-    return "".join(_MAPPING.get(ch, ch) for ch in str(text))
+    text = str(text)
+    for ch, rep in _REPLACEMENTS:
+        if ch in text:
+            text = text.replace(ch, rep)
+    return text
+
+def xml_escape_many(texts):
+    """Escapes many strings at once (``None`` becomes an empty string), returning a list"""
+    texts = ["" if t is None else str(t) for t in texts]
+    if not texts:
+        return []
+    joined = "\0".join(texts)
+    if joined.count("\0") != len(texts) - 1:
+        return [xml_escape(t) for t in texts]
+    return xml_escape(joined).split("\0")
+
+_NAME_CACHE_SIZE = 4096
+_attr_names = {}
+def _attr_name(key):
+    """Normalizes (``class_`` -> ``class``, ``data_role`` -> ``data-role``) and escapes an attribute
+    name. Pages reuse a small vocabulary of these, so the results are cached"""
+    try:
+        return _attr_names[key]
+    except KeyError:
+        name = xml_escape(key.rstrip("_").replace("_", "-"))
+        if len(_attr_names) < _NAME_CACHE_SIZE:
+            _attr_names[key] = name
+        return name
 
 class Htmlable(object):
     __slots__ = []
     
-    def render_html(self):
+    def render_html(self, minify = False):
+        """Yields ``(level, newline, text)`` tuples. When minifying, the text is concatenated as-is
+        (levels and newlines are ignored), so insignificant whitespace and comments should be 
+        omitted"""
         raise NotImplementedError()
 
 class HtmlElement(Htmlable):
-    __slots__ = ["doc", "tag", "attrs", "elements"]
+    # ``attrs`` and ``elements`` are only created when there's something to put in them (or
+    # when they're accessed), and ``doc`` is a (weak) proxy shared by all elements of the
+    # document
+    __slots__ = ["doc", "tag", "_attrs", "_elements", "_attrs_text"]
     MULTILINE = True
     
     def __init__(self, doc, tag, elems, attrs):
         self.doc = doc
-        self.tag = tag
-        self.attrs = attrs
-        self.elements = elems
+        self.tag = intern(tag)
+        self._attrs = attrs or None
+        self._elements = list(elems) if elems else None
+        self._attrs_text = None
+    
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = {}
+        # the caller may change them, so they're no longer frozen
+        self._attrs_text = None
+        return self._attrs
+    @attrs.setter
+    def attrs(self, attrs):
+        self._attrs = attrs
+        self._attrs_text = None
+    
+    @property
+    def elements(self):
+        if self._elements is None:
+            self._elements = []
+        return self._elements
+    @elements.setter
+    def elements(self, elements):
+        self._elements = elements
+    
+    def append(self, elem):
+        if self._elements is None:
+            self._elements = [elem]
+        else:
+            self._elements.append(elem)
+    def extend(self, elems):
+        if self._elements is None:
+            self._elements = list(elems)
+        else:
+            self._elements.extend(elems)
+    def update_attrs(self, attrs):
+        if self._attrs is None:
+            self._attrs = dict(attrs)
+        else:
+            self._attrs.update(attrs)
+        self._attrs_text = None
+    def freeze_attrs(self):
+        """Formats the attributes once and keeps the result, so rendering the element again does
+        no work for its attributes. Changing the attributes (through ``attrs`` or 
+        :func:`update_attrs`) unfreezes them"""
+        self._attrs_text = None
+        self._attrs_text = self._format_attrs()
     
     def __enter__(self):
         self.doc._push(self)
@@ -34,30 +119,33 @@ class HtmlElement(Htmlable):
         self.doc._pop()
     
     def _format_attrs(self):
+        if self._attrs_text is not None:
+            return self._attrs_text
+        if not self._attrs:
+            return ""
         attrs = []
-        for k, v in self.attrs.items():
+        for k, v in self._attrs.items():
             if k.startswith("_") or v is None or v is False:
                 continue
-            k = k.rstrip("_").replace("_", "-")
             if v is True:
-                attrs.append(xml_escape(k))
+                attrs.append(_attr_name(k))
             else:
-                attrs.append('%s="%s"' % (xml_escape(k), xml_escape(v)))
+                attrs.append('%s="%s"' % (_attr_name(k), xml_escape(v)))
         if attrs:
             attrs = " " + " ".join(attrs)
         else:
             attrs = ""
         return attrs
         
-    def render_html(self):
+    def render_html(self, minify = False):
         attrs = self._format_attrs()
-        if self.elements:
+        if self._elements:
             yield 0, self.MULTILINE, "<%s%s>" % (xml_escape(self.tag), attrs)
-            for elem in self.elements:
+            for elem in self._elements:
                 if elem is None:
                     continue
                 if isinstance(elem, Htmlable):
-                    for level, nl, line in elem.render_html():
+                    for level, nl, line in (elem.render_html(True) if minify else elem.render_html()):
                         yield level + 1, nl, line
                 else:
                     yield 1, False, xml_escape(elem)
@@ -73,7 +161,7 @@ class Raw(Htmlable):
     __slots__ = ["text"]
     def __init__(self, text):
         self.text = str(text)
-    def render_html(self):
+    def render_html(self, minify = False):
         return [(-1, False, self.text)]
 
 nbsp = Raw("&nbsp;")
@@ -87,8 +175,8 @@ class Comment(Htmlable):
     __slots__ = ["lines"]
     def __init__(self, lines):
         self.lines = lines
-    def render_html(self):
-        if not self.lines:
+    def render_html(self, minify = False):
+        if not self.lines or minify:
             return
         if len(self.lines) == 1:
             yield 0, True, "<!-- %s -->" % (xml_escape(self.lines[0]).replace("-->", "-- >"))
@@ -99,31 +187,53 @@ class Comment(Htmlable):
             yield 0, False, " -->"
 
 class Selector(object):
-    __slots__ = ["parent", "names", "properties"]
+    __slots__ = ["parent", "names", "properties", "_expanded"]
     def __init__(self, parent, names):
         self.parent = parent
         self.names = names
         self.properties = {}
+        self._expanded = None
     def __setitem__(self, name, value):
         self.properties[name] = str(value)
-    def render_html(self):
-        nesting = [self.names]
-        node = self.parent
-        while node:
-            nesting.append(node.names)
-            node = node.parent
-        for parts in itertools.product(*reversed(nesting)):
-            parts = [(" " if p.strip()[0] not in "+.:>#[]()," else "") + p.strip() for p in parts]
-            yield 0, True, "%s {" % ("".join(parts).strip(),)
+    def _expand(self):
+        # the (unstripped) selectors of every combination of this selector's and its parents'
+        # names, outermost-first. cached, so nesting is walked only once
+        if self._expanded is None:
+            parents = self.parent._expand() if self.parent else [""]
+            pieces = [(" " if n.strip()[0] not in "+.:>#[]()," else "") + n.strip() for n in self.names]
+            self._expanded = [p + n for p in parents for n in pieces]
+        return self._expanded
+    def render_html(self, grouped = False, minify = False):
+        selectors = [sel.strip() for sel in self._expand()]
+        if minify:
+            if not self.properties:
+                return
+            body = ";".join("%s:%s" % (key.rstrip("_").replace("_", "-"), val) for key, val in self.properties.items())
+            if grouped:
+                selectors = [",".join(selectors)]
+            for sel in selectors:
+                yield 0, False, "%s{%s}" % (sel, body)
+            return
+        if grouped:
+            selectors = [", ".join(selectors)]
+        for sel in selectors:
+            yield 0, True, "%s {" % (sel,)
             for key, val in self.properties.items():
                 yield 1, True, "%s: %s;" % (key.rstrip("_").replace("_", "-"), val)
             yield 0, True, "}"
 
 class CSS(Htmlable):
-    __slots__ = ["_curr", "_selectors"]
-    def __init__(self):
+    """
+    A style sheet. ``with css("div", "p"):`` opens a (nested) rule, whose properties are set with 
+    ``css["color"] = "red"``. Normally, each combination of nested selectors gets its own copy of
+    the properties; if ``grouped`` is set, each rule is rendered once, under a comma-separated
+    list of all of its selectors
+    """
+    __slots__ = ["_curr", "_selectors", "grouped"]
+    def __init__(self, grouped = False):
         self._curr = None
         self._selectors = []
+        self.grouped = grouped
     @contextmanager
     def __call__(self, *selectors):
         sel = Selector(self._curr if self._curr else "", selectors)
@@ -140,63 +250,152 @@ class CSS(Htmlable):
         return bool(self._selectors)
     __nonzero__ = __bool__
     
-    def render_html(self):
+    def render_html(self, minify = False):
         for sel in self._selectors:
-            for level, nl, line in sel.render_html():
+            for level, nl, line in sel.render_html(self.grouped, minify):
                 yield level, nl, line
 
 
-class HtmlDocument(object):
+class HtmlDocument(Instrumented):
     DOCTYPE = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'
-    __slots__ = ["__weakref__", "_root", "_stack", "_head_css", "_head", "_body"]
+    __slots__ = ["__weakref__", "_proxy", "_root", "_stack", "_head_css", "_head", "_body", "_stats"]
+    CHUNK_SIZE = 64 * 1024
     
     def __init__(self, xmlns = "http://www.w3.org/1999/xhtml"):
-        self._root = HtmlElement(weakref.proxy(self), "html", [], attrs = {"xmlns" : xmlns})
+        self._proxy = weakref.proxy(self)
+        self._root = HtmlElement(self._proxy, "html", (), attrs = {"xmlns" : xmlns})
         self._stack = [self._root]
         self._head = None
         self._body = None
         self._head_css = None
+        self._stats = None
     
     def __str__(self):
         return self.render()
-    def render(self, tabulator = "\t"):
-        lines = []
+    def render(self, tabulator = "\t", minify = False):
+        """Renders the document. If ``minify`` is given, indentation, newlines and comments are
+        dropped (the content of text, ``Raw`` elements and ``pre``/``textarea`` is kept as-is)"""
+        return "".join(self._parts(tabulator, minify))
+    def iter_render(self, tabulator = "\t", chunk_size = None, encoding = None, minify = False, 
+            compression = None):
+        """Renders the document incrementally, yielding chunks of (roughly) ``chunk_size`` characters.
+        If ``encoding`` is given, the chunks are encoded into bytes (so that, for instance, a WSGI
+        application can return this generator as its response body). If ``compression`` is given
+        (``"gzip"``, ``"zlib"``, ``"bz2"`` or ``"lzma"``), the encoded chunks (``utf-8`` by default) 
+        are streamed through the compressor, yielding compressed bytes"""
+        chunks = self._iter_chunks(tabulator, chunk_size, minify)
+        if compression:
+            return compress_chunks((chunk.encode(encoding or "utf-8") for chunk in chunks), compression)
+        elif encoding:
+            return (chunk.encode(encoding) for chunk in chunks)
+        else:
+            return chunks
+    def _iter_chunks(self, tabulator, chunk_size, minify):
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        buf = []
+        size = 0
+        for part in self._parts(tabulator, minify):
+            buf.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
+    def render_to(self, fileobj, tabulator = "\t", chunk_size = None, encoding = None, minify = False, 
+            compression = None):
+        """Renders the document into the given file object, writing it in chunks"""
+        for chunk in self.iter_render(tabulator, chunk_size, encoding, minify, compression):
+            fileobj.write(chunk)
+    def dump(self, filename, tabulator = "\t", encoding = "utf-8", minify = False, compression = "infer",
+            only_if_changed = False):
+        """Renders the document into the given file, compressing it as it's rendered if the file 
+        name's extension (e.g., ``.gz``) or ``compression`` calls for it. See 
+        :func:`BaseModule.dump <srcgen.base.BaseModule.dump>` for ``only_if_changed``. Returns 
+        whether the file has been written"""
+        if compression == "infer":
+            compression = infer_compression(filename)
+        make_chunks = partial(self._iter_chunks, tabulator, None, minify)
+        if self._stats is not None:
+            return self._stats._dump(self, dump_chunks, filename, make_chunks, only_if_changed, 
+                encoding, compression)
+        else:
+            return dump_chunks(filename, make_chunks, only_if_changed, encoding, compression)
+    
+    def _parts(self, tabulator, minify = False):
+        if minify:
+            parts = self._render_minified()
+        else:
+            parts = self._render_parts(tabulator)
+        if self._stats is not None:
+            parts = self._stats._render(self, parts)
+        return parts
+    def _render_parts(self, tabulator):
+        yield self.DOCTYPE
         prev_nl = False
         for level, nl, line in self._root.render_html():
             if not prev_nl and not nl:
                 level = 0
-            lines.append("%s%s%s" % ("\n" if nl or prev_nl else "", tabulator * level, line))
+            yield "%s%s%s" % ("\n" if nl or prev_nl else "", tabulator * level, line)
             prev_nl = nl
-        return self.DOCTYPE + "".join(lines)
+    def _render_minified(self):
+        yield self.DOCTYPE
+        for _, _, line in self._root.render_html(True):
+            yield line
+    
+    def freeze_attrs(self):
+        """Freezes the attributes of all elements (see :func:`HtmlElement.freeze_attrs`), e.g.,
+        before rendering the document several times"""
+        stack = [self._root]
+        while stack:
+            elem = stack.pop()
+            elem.freeze_attrs()
+            stack.extend(child for child in elem._elements or () if isinstance(child, HtmlElement))
+    
+    def _structure(self):
+        elements = 0
+        max_depth = 0
+        stack = [(self._root, 1)]
+        while stack:
+            elem, depth = stack.pop()
+            elements += 1
+            if depth > max_depth:
+                max_depth = depth
+            for child in elem._elements or ():
+                if isinstance(child, HtmlElement):
+                    stack.append((child, depth + 1))
+        return elements, max_depth
 
     def _push(self, elem):
         self._stack.append(elem)
     def _pop(self):
         self._stack.pop(-1)
     def text(self, *texts):
-        self._stack[-1].elements.extend(texts)
+        self._stack[-1].extend(texts)
     def attrs(self, **attrs):
-        self._stack[-1].attrs.update(attrs)
+        self._stack[-1].update_attrs(attrs)
     def raw(self, text):
-        self._stack[-1].elements.append(Raw(text))
+        self._stack[-1].append(Raw(text))
     def comment(self, *lines):
-        self._stack[-1].elements.append(Comment(lines))
+        self._stack[-1].append(Comment(lines))
         
     def subelem(self, tag, *elems, **attrs):
-        elem = HtmlElement(weakref.proxy(self), tag, list(elems), attrs)
-        self._stack[-1].elements.append(elem)
+        elem = HtmlElement(self._proxy, tag, elems, attrs)
+        self._stack[-1].append(elem)
         return elem
     def inline_subelem(self, tag, *elems, **attrs):
-        elem = InlineHtmlElement(weakref.proxy(self), tag, list(elems), attrs)
-        self._stack[-1].elements.append(elem)
+        elem = InlineHtmlElement(self._proxy, tag, elems, attrs)
+        self._stack[-1].append(elem)
         return elem
     
-    def head_css(self):
+    def head_css(self, grouped = False):
         if self._head_css is None:
-            self._head_css = CSS()
+            self._head_css = CSS(grouped)
             with self.head():
                 with self.style():
-                    self._stack[-1].elements.append(self._head_css)
+                    self._stack[-1].append(self._head_css)
         return self._head_css
     
     def __getattr__(self, name):
@@ -0,0 +1,110 @@
+"""
+Importing generated modules straight from memory: :class:`PythonModule <srcgen.python.PythonModule>`
+objects registered with a :class:`ModuleImporter` (which sits on ``sys.meta_path``) are
+imported like any other module, without being written to disk. A module is rendered and
+compiled only when it's first imported
+"""
+import sys
+import linecache
+import importlib.abc
+import importlib.util
+
+
+class ModuleImporter(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """
+    A finder and loader of registered modules. Packages are modules registered with
+    ``package = True``; the parents of registered modules that aren't registered themselves are
+    imported as empty packages. Registered names take precedence over modules on disk
+    """
+    def __init__(self):
+        self._modules = {}
+        self._packages = set()
+        # the number of registered modules under each parent package, so that finding a spec
+        # (which happens for every import, as the importer comes first) doesn't scan them all
+        self._parents = {}
+
+    def register(self, module, name = None, package = False):
+        """Registers ``module`` under ``name`` (by default, the name the module was created with)"""
+        if name is None:
+            name = module._name
+        if not name:
+            raise ValueError("the module has no name")
+        if name in self._modules:
+            raise ValueError("%r is already registered" % (name,))
+        self._modules[name] = module
+        if package:
+            self._packages.add(name)
+        for parent in self._parent_names(name):
+            self._parents[parent] = self._parents.get(parent, 0) + 1
+        return module
+
+    def unregister(self, name):
+        """Removes the module registered under ``name``; it isn't removed from ``sys.modules``"""
+        del self._modules[name]
+        self._packages.discard(name)
+        for parent in self._parent_names(name):
+            self._parents[parent] -= 1
+            if not self._parents[parent]:
+                del self._parents[parent]
+
+    def __contains__(self, name):
+        return name in self._modules
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    @staticmethod
+    def _parent_names(name):
+        parts = name.split(".")
+        return [".".join(parts[:i]) for i in range(1, len(parts))]
+
+    def _is_package(self, fullname):
+        return fullname in self._packages or fullname in self._parents
+
+    def find_spec(self, fullname, path = None, target = None):
+        if fullname not in self._modules and not self._is_package(fullname):
+            return None
+        return importlib.util.spec_from_loader(fullname, self, origin = self._filename(fullname),
+            is_package = self._is_package(fullname))
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        fullname = module.__spec__.name
+        gen = self._modules.get(fullname)
+        if gen is None:
+            # an implicit parent package
+            return
+        filename = self._filename(fullname)
+        code = gen.compile(filename)
+        # lets tracebacks and ``inspect`` show the generated source
+        linecache.lazycache(filename, module.__dict__)
+        exec(code, module.__dict__)
+
+    def get_source(self, fullname):
+        gen = self._modules.get(fullname)
+        return gen.render() if gen is not None else ""
+
+    def is_package(self, fullname):
+        return self._is_package(fullname)
+
+    @staticmethod
+    def _filename(fullname):
+        return "srcgen:%s" % (fullname,)
+
+
+importer = ModuleImporter()
+
+def register(module, name = None, package = False):
+    """Registers ``module`` with the default importer (see :func:`ModuleImporter.register`),
+    installing the importer on ``sys.meta_path`` if it isn't there yet"""
+    importer.install()
+    return importer.register(module, name, package)
+
+def unregister(name):
+    importer.unregister(name)
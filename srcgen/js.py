@@ -1,34 +1,63 @@
 import json
-from srcgen.base import BaseModule
+from srcgen.base import BaseModule, _split_lines
 from contextlib import contextmanager
 from srcgen.html import Htmlable, xml_escape
 
 
+class _Comment(str):
+    """Marks comment lines, so that minified rendering can drop them"""
+    __slots__ = []
+
+
 class JS(BaseModule, Htmlable):
     def comment(self, *lines, **kwargs):
         box = kwargs.pop("box", False)
         sep = kwargs.pop("sep", False)
+        lines = "\n".join(lines).splitlines()
+        if not lines:
+            # otherwise the previous line would be closed (and marked) as a comment
+            return
         if sep and box:
             self._append("")
-            self._append("/* " + "*" * (self._line_width-2))
+            self._append(_Comment("/* " + "*" * (self._line_width-2)))
         elif sep:
-            self._append("/*")
+            self._append(_Comment("/*"))
         elif box:
-            self._append("/* " + "*" * (self._line_width-2))
-        self._curr.extend("/* %s" % (l.replace("*/", "* /"),) for l in "\n".join(lines).splitlines())
+            self._append(_Comment("/* " + "*" * (self._line_width-2)))
+        self._curr.extend(_Comment("/* %s" % (l.replace("*/", "* /"),)) for l in lines)
         if sep and box:
-            self._append("*" * (self._line_width - 2) + " */")
+            self._append(_Comment("*" * (self._line_width - 2) + " */"))
             self._append("")
         elif sep:
-            self._append("*/")
+            self._append(_Comment("*/"))
         elif box:
-            self._append("*" * (self._line_width - 2) + " */")
+            self._append(_Comment("*" * (self._line_width - 2) + " */"))
+        else:
+            self._curr[-1] = _Comment(self._curr[-1] + " */")
+    
+    def render_html(self, minify = False):
+        if minify:
+            for text in self.iter_minified():
+                yield 0, False, xml_escape(text)
         else:
-            self._curr[-1] += " */"
+            for line in _split_lines(xml_escape(chunk) for chunk in self.iter_chunks()):
+                yield 0, True, line
     
-    def render_html(self):
-        for line in xml_escape(self.render()).splitlines():
-            yield 0, True, line
+    def iter_minified(self):
+        """Renders the code without indentation, comments and blank lines. Newlines are kept only
+        where the previous line doesn't end with one of ``;{,:`` (where automatic semicolon 
+        insertion might depend on them)"""
+        sep = ""
+        for _, elem in self._walk(self._curr):
+            if isinstance(elem, _Comment):
+                continue
+            line = str(elem).strip()
+            if not line:
+                continue
+            yield sep + line
+            sep = "" if line[-1] in ";{,:" else "\n"
+    def render_minified(self):
+        return "".join(self.iter_minified())
     
     def stmt(self, text, *args, **kwargs):
         text = str(text)
@@ -56,11 +85,7 @@ class JS(BaseModule, Htmlable):
         if headline[-1] not in "{:":
             headline += " {"
         self._append(headline.format(*args) if args else headline)
-        prev = self._curr
-        self._curr = []
-        prev.append(self._curr)
-        yield
-        self._curr = prev
+        with self._indented(): yield
         if terminator is None:
             self._append("}")
         else:
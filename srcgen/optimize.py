@@ -0,0 +1,406 @@
+"""
+Constant folding and common-subexpression elimination over expression objects
+(:class:`BaseE <srcgen.base.BaseE>` and its subclasses). Usually used through the modules'
+``optimize`` methods, e.g., :func:`PythonModule.optimize <srcgen.python.PythonModule.optimize>`
+"""
+import re
+from srcgen.base import BaseE
+
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<str>[rRbBuUfF]{0,2}(?:'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*"))
+  | (?P<num>\d(?:[eE][+-]\d|[\w.])*)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op>\*\*|//|<<|>>|<=|>=|==|!=|->|&&|\|\||[-+*/%&|^~<>()\[\].,=!?:])
+  | (?P<bad>\S)
+)""", re.X)
+
+BINARY_OPS = frozenset(["+", "-", "*", "/", "//", "%", "**", "|", "&", "^", "<<", ">>", "<", ">", "<=", ">=",
+    "==", "!=", "&&", "||", "or", "and"])
+PREFIX_OPS = frozenset(["-", "+", "~", "!", "*", "&", "not"])
+# the right operand of these is evaluated conditionally, so it mustn't be hoisted out of them
+SHORT_CIRCUIT_OPS = frozenset(["&&", "||", "or", "and"])
+# prefix operators that bind looser than some binary operators (e.g., -x ** 2 is -(x ** 2))
+LOOSE_PREFIX_OPS = {
+    "not" : frozenset(BINARY_OPS - set(["or", "and"])),
+    "-" : frozenset(["**"]),
+    "+" : frozenset(["**"]),
+    "~" : frozenset(["**"]),
+}
+_NOT_HOISTED = frozenset(["atom", "num", "text", "paren"])
+try:
+    _RecursionError = RecursionError
+except NameError:
+    # python < 3.5
+    _RecursionError = RuntimeError
+
+
+class _ParseError(Exception):
+    pass
+
+def _tokenize_text(text):
+    tokens = []
+    for m in _TOKEN.finditer(text):
+        kind = m.lastgroup
+        if kind == "bad":
+            raise _ParseError(text)
+        tokens.append((kind, m.group(kind)))
+    return tokens
+
+def _tokenize(pieces, refs, cache):
+    tokens = []
+    for piece in pieces:
+        if isinstance(piece, BaseE):
+            tokens.append(("ref", refs[id(piece)]))
+            continue
+        # the operators' pieces ("(", " + ", ...) are tokenized once
+        try:
+            tokens.extend(cache[piece])
+        except KeyError:
+            cache[piece] = toks = _tokenize_text(piece)
+            tokens.extend(toks)
+    return tokens
+
+
+class _Graph(object):
+    """The expressions as a DAG of hash-consed nodes, each of which is a ``(kind, data, children)``
+    tuple. Children always precede their parents, so walking the nodes by index never recurses"""
+    def __init__(self, cls, fold):
+        self.cls = cls
+        self.fold = fold
+        self.nodes = []
+        self.values = {}
+        self._index = {}
+
+    def add(self, kind, data, children = ()):
+        key = (kind, data, children)
+        try:
+            return self._index[key]
+        except KeyError:
+            pass
+        if self.fold:
+            folded = self._fold(kind, data, children)
+            if folded is not None:
+                return folded
+        self.nodes.append(key)
+        self._index[key] = n = len(self.nodes) - 1
+        return n
+
+    def add_literal(self, text):
+        value = self.cls._fold_literal(text)
+        if value is None:
+            return self.add("atom", text)
+        n = self.add("num", text)
+        self.values[n] = value
+        return n
+
+    def _fold(self, kind, data, children):
+        if not all(c in self.values for c in children):
+            return None
+        if kind == "bin":
+            func = self.cls._FOLD_OPS.get(data)
+        elif kind == "pre":
+            func = self.cls._FOLD_UNARY.get(data)
+        elif kind == "paren":
+            return children[0]
+        else:
+            return None
+        if func is None:
+            return None
+        try:
+            value = func(*[self.values[c] for c in children])
+        except (ArithmeticError, ValueError):
+            return None
+        if value is None:
+            return None
+        text = repr(value)
+        if kind == "bin" and text.startswith("-"):
+            # unlike a folded prefix operator, whose text is the same as before, a negative result
+            # of a binary operator doesn't bind tighter than what follows it (e.g., (0 - 5) ** 2)
+            text = "(%s)" % (text,)
+        n = self.add("num", text)
+        self.values[n] = value
+        return n
+
+
+class _Parser(object):
+    """A recursive-descent parser for the expressions that ``E`` renders: fully parenthesized
+    binary operators, prefix operators, and indexing, attribute access and calls. Sub-expressions
+    are given as ``ref`` tokens, so the recursion depth is bounded by a single node's text"""
+    def __init__(self, graph, tokens):
+        self.graph = graph
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+    def next(self):
+        tok = self.peek()
+        if tok[0] is None:
+            raise _ParseError("unexpected end")
+        self.pos += 1
+        return tok
+    def expect(self, text):
+        if self.next()[1] != text:
+            raise _ParseError("expected %r" % (text,))
+
+    def parse(self):
+        n = self.expr()
+        if self.pos != len(self.tokens):
+            raise _ParseError("trailing tokens")
+        return n
+
+    def expr(self):
+        prefixes, n = self.unary()
+        return self.prefixed(prefixes, n)
+
+    def unary(self):
+        """Returns the prefix operators (outermost first) and the operand they apply to, which
+        are only combined once it's known what follows them"""
+        prefixes = []
+        while True:
+            kind, text = self.peek()
+            if kind not in ("op", "name") or text not in PREFIX_OPS:
+                break
+            self.pos += 1
+            prefixes.append(text)
+        kind = self.peek()[0]
+        n = self.primary()
+        if kind == "ref":
+            # a sub-expression is substituted as is, so its own prefix operators apply to
+            # whatever follows it as well
+            n = self.peel(n, prefixes)
+        return prefixes, self.postfix(n)
+
+    def peel(self, n, prefixes):
+        while True:
+            kind, data, children = self.graph.nodes[n]
+            if kind == "pre":
+                prefixes.append(data)
+                n = children[0]
+            elif kind == "num" and data.startswith("-"):
+                # a folded prefix operator
+                prefixes.append("-")
+                n = self.graph.add_literal(data[1:])
+            else:
+                return n
+
+    def prefixed(self, prefixes, n):
+        for op in reversed(prefixes):
+            n = self.graph.add("pre", op, (n,))
+        return n
+
+    def primary(self):
+        kind, text = self.next()
+        if kind == "ref":
+            return text
+        elif kind == "num":
+            return self.graph.add_literal(text)
+        elif kind == "str" or (kind == "name" and text not in BINARY_OPS):
+            return self.graph.add("atom", text)
+        elif text == "(":
+            prefixes, lhs = self.unary()
+            kind, text = self.next()
+            if text == ")":
+                return self.graph.add("paren", None, (self.prefixed(prefixes, lhs),))
+            if kind not in ("op", "name") or text not in BINARY_OPS:
+                raise _ParseError("expected an operator")
+            # the outer prefix operators that bind looser than the operator apply to all of it
+            loose = 0
+            while loose < len(prefixes) and text in LOOSE_PREFIX_OPS.get(prefixes[loose], ()):
+                loose += 1
+            if any(text in LOOSE_PREFIX_OPS.get(op, ()) for op in prefixes[loose:]):
+                raise _ParseError("ambiguous prefix operators")
+            rhs = self.expr()
+            self.expect(")")
+            n = self.graph.add("bin", text, (self.prefixed(prefixes[loose:], lhs), rhs))
+            if loose:
+                n = self.graph.add("paren", None, (self.prefixed(prefixes[:loose], n),))
+            return n
+        raise _ParseError("unexpected %r" % (text,))
+
+    def postfix(self, n):
+        while True:
+            kind, text = self.peek()
+            if text == "[":
+                self.pos += 1
+                index = self.expr()
+                self.expect("]")
+                n = self.graph.add("index", None, (n, index))
+            elif text in (".", "->"):
+                self.pos += 1
+                kind, name = self.next()
+                if kind != "name":
+                    raise _ParseError("expected a name")
+                n = self.graph.add("attr", text + name, (n,))
+            elif text == "(":
+                self.pos += 1
+                n = self.call(n)
+            else:
+                return n
+
+    def call(self, func):
+        names = []
+        args = []
+        if self.peek()[1] == ")":
+            self.pos += 1
+        else:
+            while True:
+                kind, text = self.peek()
+                if kind == "name" and self.pos + 1 < len(self.tokens) and self.tokens[self.pos + 1][1] == "=":
+                    self.pos += 2
+                    names.append(text)
+                else:
+                    names.append(None)
+                args.append(self.expr())
+                if self.next()[1] == ")":
+                    break
+                if self.tokens[self.pos - 1][1] != ",":
+                    raise _ParseError("expected ','")
+        return self.graph.add("call", tuple(names), (func,) + tuple(args))
+
+
+def _build(graph, roots):
+    """Adds the given expressions to the graph, returning their nodes. Each distinct expression
+    object is parsed once, after its sub-expressions; text that can't be parsed becomes an
+    opaque node (which still has its sub-expressions as children)"""
+    refs = {}
+    texts = {}
+    cache = {}
+    for root in roots:
+        stack = [(root, False)]
+        while stack:
+            expr, ready = stack.pop()
+            if id(expr) in refs:
+                continue
+            value = expr._value
+            if not isinstance(value, tuple):
+                # leaves (and small, already joined, expressions) tend to repeat
+                if value not in texts:
+                    texts[value] = _parse(graph, (value,), refs, cache)
+                refs[id(expr)] = texts[value]
+                continue
+            pieces = value
+            if not ready:
+                stack.append((expr, True))
+                stack.extend((p, False) for p in pieces if isinstance(p, BaseE) and id(p) not in refs)
+                continue
+            refs[id(expr)] = _parse(graph, pieces, refs, cache)
+    return [refs[id(root)] for root in roots]
+
+def _parse(graph, pieces, refs, cache):
+    try:
+        return _Parser(graph, _tokenize(pieces, refs, cache)).parse()
+    except (_ParseError, _RecursionError):
+        return graph.add("text", tuple(None if isinstance(p, BaseE) else p for p in pieces),
+            tuple(refs[id(p)] for p in pieces if isinstance(p, BaseE)))
+
+def _render(graph, n, children):
+    kind, data, nodes = graph.nodes[n]
+    if kind in ("atom", "num"):
+        return (data,)
+    first = (children[0],) if children else ()
+    if kind in ("pre", "index", "attr", "call") or (kind == "bin" and data == "**"):
+        # a folded negative literal binds looser than these (e.g., -5 ** n or -5[i])
+        kind0, data0, _ = graph.nodes[nodes[0]]
+        if kind0 == "num" and data0.startswith("-"):
+            first = ("(", children[0], ")")
+    if kind == "bin":
+        return ("(",) + first + (" %s " % (data,), children[1], ")")
+    elif kind == "pre":
+        return ("not " if data == "not" else data,) + first
+    elif kind == "paren":
+        return ("(", children[0], ")")
+    elif kind == "index":
+        return first + ("[", children[1], "]")
+    elif kind == "attr":
+        return first + (data,)
+    elif kind == "call":
+        pieces = list(first) + ["("]
+        for name, arg in zip(data, children[1:]):
+            if name is not None:
+                pieces.append("%s = " % (name,))
+            pieces.extend((arg, ", "))
+        if len(pieces) > len(first) + 1:
+            pieces.pop()
+        pieces.append(")")
+        return pieces
+    else:
+        children = iter(children)
+        return [next(children) if p is None else p for p in data]
+
+
+def optimize(exprs, names, cls = None, fold = True, cse = True, min_uses = 2):
+    """
+    Optimizes the given expressions, returning ``(temps, exprs)``: a list of ``(name, expr)``
+    temporaries, which have to be assigned (in this order) before the optimized expressions
+    are evaluated, and the optimized expressions. ``names`` is an iterator of names for the
+    temporaries, and ``cls`` is the expression class (by default, that of the first expression).
+
+    If ``fold`` is set, operators whose operands are literals are evaluated, as far as
+    ``cls._FOLD_OPS``/``cls._FOLD_UNARY`` allow. If ``cse`` is set, sub-expressions that are used
+    at least ``min_uses`` times are computed once, into a temporary. Calls are never hoisted
+    (they are made just as often as before), nor is anything that's only evaluated conditionally
+    (the right operand of ``and``/``or``/``&&``/``||``). Neither are nodes whose kind isn't in
+    ``cls._HOISTED_KINDS`` (unless it's None), the results of the binary and prefix operators
+    in ``cls._NOT_HOISTED_OPS`` and ``cls._NOT_HOISTED_PREFIX_OPS``, nor, unless
+    ``cls._HOIST_SUBSCRIPTS`` is set, anything within a subscript
+    """
+    if cls is None:
+        cls = next((e.__class__ for e in exprs if isinstance(e, BaseE)), BaseE)
+    exprs = [e if isinstance(e, BaseE) else cls(e) for e in exprs]
+    graph = _Graph(cls, fold)
+    roots = _build(graph, exprs)
+    nodes = graph.nodes
+
+    count = len(nodes)
+    reachable = [False] * count
+    unconditional = [False] * count
+    uses = [0] * count
+    for r in roots:
+        reachable[r] = unconditional[r] = True
+        uses[r] += 1
+    for n in range(count - 1, -1, -1):
+        if not reachable[n]:
+            continue
+        kind, data, children = nodes[n]
+        for i, c in enumerate(children):
+            reachable[c] = True
+            uses[c] += 1
+            if unconditional[n] and kind != "text" and not (i == 1 and kind == "bin" and data in SHORT_CIRCUIT_OPS):
+                unconditional[c] = True
+
+    has_call = [False] * count
+    for n, (kind, _, children) in enumerate(nodes):
+        has_call[n] = kind in ("call", "text") or any(has_call[c] for c in children)
+    if cls._HOIST_SUBSCRIPTS:
+        in_subscript = None
+    else:
+        in_subscript = [False] * count
+        for n in range(count - 1, -1, -1):
+            kind, _, children = nodes[n]
+            if in_subscript[n]:
+                for c in children:
+                    in_subscript[c] = True
+            elif kind == "index":
+                in_subscript[children[1]] = True
+
+    proto = cls.__new__(cls)
+    temps = []
+    used = {}
+    for n in range(count):
+        if not reachable[n]:
+            continue
+        pieces = _render(graph, n, [used[c] for c in nodes[n][2]])
+        expr = BaseE._node(proto, *pieces)
+        kind, data, _ = nodes[n]
+        if (cse and uses[n] >= min_uses and unconditional[n] and not has_call[n] and kind not in _NOT_HOISTED and
+                (cls._HOISTED_KINDS is None or kind in cls._HOISTED_KINDS) and
+                not (kind == "bin" and data in cls._NOT_HOISTED_OPS) and
+                not (kind == "pre" and data in cls._NOT_HOISTED_PREFIX_OPS) and
+                not (in_subscript is not None and in_subscript[n])):
+            name = next(names)
+            temps.append((name, expr))
+            expr = cls(name)
+        used[n] = expr
+    return temps, [used[r] for r in roots]
@@ -0,0 +1,135 @@
+import os
+import stat
+import zlib
+import locale
+import hashlib
+import tempfile
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+BLOCK_SIZE = 64 * 1024
+
+COMPRESSION_EXTENSIONS = {".gz" : "gzip", ".z" : "zlib", ".zz" : "zlib", ".bz2" : "bz2", ".xz" : "lzma", 
+    ".lzma" : "lzma"}
+
+def infer_compression(filename):
+    """Returns the compression implied by the file's extension (``None`` if it's not one of
+    :data:`COMPRESSION_EXTENSIONS`)"""
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+def _compressor(compression):
+    if compression == "gzip":
+        # zlib's gzip header has a zero mtime, so equal text gives equal bytes
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == "zlib":
+        return zlib.compressobj()
+    elif compression == "bz2" and bz2 is not None:
+        return bz2.BZ2Compressor()
+    elif compression == "lzma" and lzma is not None:
+        return lzma.LZMACompressor()
+    elif compression in ("bz2", "lzma"):
+        raise ValueError("%s compression is not available" % (compression,))
+    else:
+        raise ValueError("Unknown compression %r" % (compression,))
+
+def compress_chunks(chunks, compression):
+    """Streams the given byte chunks through a ``"gzip"``, ``"zlib"``, ``"bz2"`` or ``"lzma"``
+    compressor, yielding the compressed bytes as the compressor produces them"""
+    comp = _compressor(compression)
+    for chunk in chunks:
+        data = comp.compress(chunk)
+        if data:
+            yield data
+    data = comp.flush()
+    if data:
+        yield data
+
+def encode_chunks(chunks, encoding = None, compression = None):
+    """Encodes the given text chunks (by default, in the locale's preferred encoding) and 
+    compresses them, if ``compression`` is given"""
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    chunks = (chunk.encode(encoding) for chunk in chunks)
+    if compression:
+        chunks = compress_chunks(chunks, compression)
+    return chunks
+
+def _file_digest(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.digest()
+
+def _write_all(fileobj, chunks):
+    for chunk in chunks:
+        fileobj.write(chunk)
+
+# the umask can only be read by setting it, which would race with other threads if it were done
+# on every write, so new files get the mode implied by the umask at import time
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+_NEW_FILE_MODE = 0o666 & ~_UMASK
+
+def dump_chunks(filename, make_chunks, only_if_changed = False, encoding = None, compression = None):
+    """
+    Writes the text chunks produced by ``make_chunks()`` into ``filename``. If
+    ``only_if_changed`` is set, the text is written into a temporary file (hashing it on the
+    way) that then atomically replaces ``filename``, unless the file already holds the very
+    same content, in which case it's left untouched (so its mtime doesn't change).
+
+    If ``compression`` is given (see :func:`compress_chunks`), the chunks are compressed as they
+    are written, and ``only_if_changed`` compares the compressed bytes.
+
+    Returns whether the file has been (re)written
+    """
+    if not only_if_changed:
+        if compression or encoding:
+            with open(filename, "wb") as f:
+                _write_all(f, encode_chunks(make_chunks(), encoding, compression))
+        else:
+            with open(filename, "w") as f:
+                _write_all(f, make_chunks())
+        return True
+
+    return replace_file(filename, encode_chunks(make_chunks(), encoding, compression), True)
+
+def replace_file(filename, chunks, only_if_changed = False):
+    """Writes the given bytes chunks into a temporary file that then atomically replaces
+    ``filename`` (keeping its mode), so readers never see a partial file. If ``only_if_changed``
+    is set and the file already holds the very same bytes, it's left untouched. Returns whether
+    the file has been (re)written"""
+    dirname, basename = os.path.split(filename)
+    fd, tmpname = tempfile.mkstemp(prefix = "." + basename + ".", suffix = ".tmp", dir = dirname or ".")
+    try:
+        size = 0
+        h = hashlib.sha1()
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+                h.update(chunk)
+        if os.path.isfile(filename):
+            if only_if_changed and os.path.getsize(filename) == size and _file_digest(filename) == h.digest():
+                os.unlink(tmpname)
+                return False
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        else:
+            mode = _NEW_FILE_MODE
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+    return True
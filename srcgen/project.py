@@ -0,0 +1,105 @@
+import os
+import pickle
+import itertools
+from timeit import default_timer
+from collections import namedtuple
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+
+DumpResult = namedtuple("DumpResult", ["path", "elapsed", "changed", "stats"])
+
+def _dump_module(path, filename, module, only_if_changed):
+    t0 = default_timer()
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another worker may have just created it
+            if not os.path.isdir(dirname):
+                raise
+    # by keyword, as HtmlDocument.dump takes other arguments first
+    changed = module.dump(filename, only_if_changed = only_if_changed)
+    stats = module.stats.to_dict() if module.stats is not None else None
+    return DumpResult(path, default_timer() - t0, changed, stats)
+
+def _dump_pickled(path, filename, data, only_if_changed):
+    return _dump_module(path, filename, pickle.loads(data), only_if_changed)
+
+def _pickled(module):
+    """The pickled module, or None if it can't be pickled (e.g., it holds a lambda)"""
+    try:
+        return pickle.dumps(module, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError, RuntimeError):
+        # RuntimeError covers RecursionError, for very deep structures
+        return None
+
+
+class Project(object):
+    """
+    A collection of modules (any :class:`BaseModule <srcgen.base.BaseModule>`), keyed by their
+    output path (relative to ``root``), that are rendered and written together. Rendering is
+    spread over a pool of ``workers`` processes (``None`` means one per CPU); with a single
+    worker, or where ``concurrent.futures`` isn't available, modules are dumped serially in the
+    current process. Either way, each module is rendered straight into its file by whichever
+    process dumps it, so the rendered text is never collected in the main process.
+
+    Modules are pickled to be sent to the workers; those that can't be pickled (e.g., ones
+    instrumented with a lambda as the stats callback) are dumped in the current process, while
+    the workers dump the rest. Note that the stats callbacks of modules that are dumped by a
+    worker are called in the worker, where their effects are lost; the stats themselves are
+    returned in the :class:`DumpResult`
+    """
+    def __init__(self, root = ".", workers = None):
+        self.root = root
+        self.workers = workers
+        self._modules = {}
+
+    def add(self, path, module):
+        if path in self._modules:
+            raise ValueError("%r is already in the project" % (path,))
+        self._modules[path] = module
+        return module
+    def __getitem__(self, path):
+        return self._modules[path]
+    def __contains__(self, path):
+        return path in self._modules
+    def __len__(self):
+        return len(self._modules)
+    def __iter__(self):
+        return iter(sorted(self._modules))
+
+    def dump(self, workers = None, only_if_changed = False):
+        """Renders and writes all modules, returning a list of :class:`DumpResult` (the path,
+        the time it took to dump it, whether the file has changed and the module's stats, if
+        it's instrumented), ordered by path. See :func:`BaseModule.dump <srcgen.base.BaseModule.dump>`
+        for ``only_if_changed`` and :func:`srcgen.stats.aggregate` for combining the stats"""
+        if workers is None:
+            workers = self.workers
+        if workers is None:
+            # cpu_count() returns None if the number can't be determined
+            workers = (os.cpu_count() if hasattr(os, "cpu_count") else None) or 1
+        paths = list(self)
+        filenames = [os.path.join(self.root, p) for p in paths]
+        modules = [self._modules[p] for p in paths]
+        flags = itertools.repeat(only_if_changed, len(paths))
+        if ProcessPoolExecutor is None or workers <= 1 or len(paths) <= 1:
+            return [_dump_module(*args) for args in zip(paths, filenames, modules, flags)]
+        pickled = []
+        local = []
+        for args in zip(paths, filenames, modules, flags):
+            data = _pickled(args[2])
+            if data is None:
+                local.append(args)
+            else:
+                pickled.append(args[:2] + (data,) + args[3:])
+        with ProcessPoolExecutor(workers) as executor:
+            chunksize = max(1, len(pickled) // (workers * 4))
+            results = executor.map(_dump_pickled, *zip(*pickled), chunksize = chunksize) if pickled else ()
+            # the unpicklable modules are dumped while the workers are busy with the rest
+            results = [_dump_module(*args) for args in local] + list(results)
+        results.sort(key = lambda r: r.path)
+        return results
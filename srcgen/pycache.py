@@ -0,0 +1,111 @@
+"""
+Content-addressed caching of compiled Python code: in memory, in a cache directory and as
+``.pyc`` files (in the hash-based format of PEP 552, so the import system validates them by
+the source's hash rather than by its mtime)
+"""
+import os
+import sys
+import struct
+import marshal
+import hashlib
+import tempfile
+import importlib.util
+
+
+_MEMORY_CACHE_SIZE = 256
+_code_cache = {}
+
+# PEP 552 flags: hash-based, checked against the source on import
+_CHECKED_HASH = 0b11
+
+def code_to_pyc(code, source):
+    """Returns the contents of a (checked, hash-based) ``.pyc`` file for the given code object,
+    compiled from ``source`` (bytes)"""
+    return b"".join([importlib.util.MAGIC_NUMBER, struct.pack("<I", _CHECKED_HASH),
+        importlib.util.source_hash(source), marshal.dumps(code)])
+
+def _matches(data, source):
+    return (len(data) >= 16 and data[:4] == importlib.util.MAGIC_NUMBER and 
+        struct.unpack("<I", data[4:8])[0] == _CHECKED_HASH and data[8:16] == importlib.util.source_hash(source))
+
+def pyc_to_code(data, source):
+    """Returns the code object of the given ``.pyc`` contents, or None if it's not a checked
+    ``.pyc`` of ``source`` for this Python version"""
+    if not _matches(data, source):
+        return None
+    try:
+        return marshal.loads(data[16:])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def _makedirs(dirname):
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another process may have just created it
+            if not os.path.isdir(dirname):
+                raise
+
+def write_atomic(path, data):
+    """Writes ``data`` (bytes) into a temporary file that then replaces ``path``, so that a
+    concurrent reader never sees a partial file"""
+    dirname, basename = os.path.split(path)
+    fd, tmpname = tempfile.mkstemp(prefix = "." + basename + ".", suffix = ".tmp", dir = dirname or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+def compile_source(source, filename, cache_dir = None, optimize = -1):
+    """
+    Compiles ``source`` (bytes) into a code object. Code objects are cached in memory by the
+    source's SHA-256 (along with the file name and the optimization level, which end up in the
+    code object) and, if ``cache_dir`` is given, as ``.pyc`` files in that directory, so that
+    other processes don't have to compile the same source again
+    """
+    key = hashlib.sha256(b"\0".join([source, filename.encode("utf-8"), str(optimize).encode("ascii")])).hexdigest()
+    try:
+        return _code_cache[key]
+    except KeyError:
+        pass
+    code = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, "%s.%s.pyc" % (key, sys.implementation.cache_tag))
+        data = _read(path)
+        if data is not None:
+            code = pyc_to_code(data, source)
+    if code is None:
+        code = compile(source, filename, "exec", dont_inherit = True, optimize = optimize)
+        if cache_dir is not None:
+            _makedirs(cache_dir)
+            write_atomic(path, code_to_pyc(code, source))
+    if len(_code_cache) >= _MEMORY_CACHE_SIZE:
+        del _code_cache[next(iter(_code_cache))]
+    _code_cache[key] = code
+    return code
+
+def write_pyc(filename, source, code = None, only_if_changed = False):
+    """Writes the ``.pyc`` of ``filename`` (whose content is ``source``) where the import system
+    looks for it (``__pycache__``), returning whether it has been written. If ``only_if_changed``
+    is set and there's already a valid ``.pyc`` for this source, it's left as it is"""
+    path = importlib.util.cache_from_source(filename)
+    if only_if_changed:
+        data = _read(path)
+        if data is not None and _matches(data, source):
+            return False
+    if code is None:
+        code = compile_source(source, filename)
+    _makedirs(os.path.dirname(path))
+    write_atomic(path, code_to_pyc(code, source))
+    return True
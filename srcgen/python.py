@@ -1,11 +1,23 @@
 from __future__ import with_statement
+import io
+import os
+import math
+import zlib
+import base64
 import pickle
+import operator
 import six
 from contextlib import contextmanager
-from srcgen.base import BaseModule, BaseE, R
+from srcgen.base import BaseModule, BaseE, R, _operand
+from srcgen.output import dump_chunks, infer_compression, replace_file
+from srcgen.optimize import optimize as _optimize
 
 
 class PythonModule(BaseModule):
+    def __init__(self, *args, **kwargs):
+        BaseModule.__init__(self, *args, **kwargs)
+        self._sidecars = {}
+    
     def comment(self, *lines, **kwargs):
         box = kwargs.pop("box", False)
         sep = kwargs.pop("sep", False)
@@ -32,6 +44,15 @@ class PythonModule(BaseModule):
         self._append(text.format(*args) if args else text)
     def doc(self, text):
         self.stmt(repr(text))
+    def optimize(self, *exprs, **kwargs):
+        """Folds constants in the given expressions and assigns their common sub-expressions to
+        temporaries (named ``prefix`` + a number; ``_t`` by default), returning the optimized
+        expressions. See :func:`srcgen.optimize.optimize` for the other keyword arguments"""
+        prefix = kwargs.pop("prefix", "_t")
+        temps, exprs = _optimize(exprs, self._temp_names(prefix), E, **kwargs)
+        for name, expr in temps:
+            self.stmt("%s = %s" % (name, expr))
+        return exprs
     def break_(self):
         self.stmt("break")
     def continue_(self):
@@ -49,17 +70,149 @@ class PythonModule(BaseModule):
     def pass_(self):
         self.stmt("pass")
     
+    #
+    # Sidecar constants
+    #
+    def sidecar_loader(self):
+        """Emits the ``_sidecar`` function that loads (and caches) the constants of 
+        :func:`sidecar`. It has to be emitted at the module's top level, before any top-level 
+        code uses these constants. The files are found next to the module's ``__file__``, so
+        the module must be dumped into a file and imported (or executed) from there"""
+        self.stmt("_sidecars = {}")
+        with self.def_("_sidecar", "filename", "mmap_mode = None"):
+            with self.try_():
+                self.return_("_sidecars[filename]")
+            with self.except_(["KeyError"]):
+                self.pass_()
+            self.import_("os")
+            self.stmt("path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)")
+            with self.if_("filename.endswith('.npy')"):
+                self.import_("numpy")
+                self.stmt("value = numpy.load(path, mmap_mode = mmap_mode, allow_pickle = False)")
+            with self.elif_("mmap_mode"):
+                self.import_("mmap")
+                with self.suite("with open(path, 'rb') as f:"):
+                    self.stmt("value = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)")
+            with self.else_():
+                self.import_("pickle")
+                with self.suite("with open(path, 'rb') as f:"):
+                    self.stmt("value = pickle.load(f)")
+            self.stmt("_sidecars[filename] = value")
+            self.return_("value")
+    
+    def sidecar(self, name, obj, protocol = pickle.HIGHEST_PROTOCOL, mmap_mode = None, filename = None):
+        """
+        Stores ``obj`` in a separate file, written next to the module when it's dumped into a
+        file (or by :func:`write_sidecars`), instead of embedding it in the source. Returns an
+        expression that loads it the first time it's evaluated (see :func:`sidecar_loader`).
+
+        Objects are pickled by default. With a ``mmap_mode``, a numpy array is saved as a 
+        ``.npy`` file and loaded with ``numpy.load(mmap_mode = mmap_mode)``, and bytes are 
+        written as-is and memory-mapped (read-only). The file is named after ``name``, unless 
+        ``filename`` is given
+        """
+        if mmap_mode and type(obj).__module__ == "numpy" and hasattr(obj, "dtype"):
+            import numpy
+            buf = io.BytesIO()
+            numpy.save(buf, obj, allow_pickle = False)
+            data, ext = buf.getvalue(), ".npy"
+        elif mmap_mode and isinstance(obj, (bytes, bytearray)):
+            data, ext = bytes(obj), ".bin"
+        elif mmap_mode:
+            raise TypeError("mmap_mode requires a numpy array or bytes, not %r" % (type(obj),))
+        else:
+            data, ext = pickle.dumps(obj, protocol), ".pickle"
+        if filename is None:
+            filename = name + ext
+        if self._sidecars.get(filename, data) != data:
+            raise ValueError("%r is already used by another sidecar" % (filename,))
+        self._sidecars[filename] = data
+        if mmap_mode:
+            return E("_sidecar(%r, %r)" % (filename, mmap_mode))
+        else:
+            return E("_sidecar(%r)" % (filename,))
+    
+    def write_sidecars(self, dirname, only_if_changed = False):
+        """Writes the sidecar files into ``dirname`` (each replacing the old one atomically, as
+        the module may be in use), returning whether any of them was written"""
+        changed = False
+        for filename, data in sorted(self._sidecars.items()):
+            changed = replace_file(os.path.join(dirname, filename), [data], only_if_changed) or changed
+        return changed
+    
+    #
+    # Compilation
+    #
+    def compile(self, filename = None, cache_dir = None, optimize = -1):
+        """Renders the module and compiles it into a code object (e.g., for ``exec``). Code 
+        objects are cached by the rendered text, in memory and, if ``cache_dir`` is given, on 
+        disk, so the same text is compiled only once (see :func:`srcgen.pycache.compile_source`).
+        Modules with sidecar constants can't be compiled, as they're loaded from files next to
+        the module's ``__file__``"""
+        if self._sidecars:
+            raise ValueError("modules with sidecar constants must be dumped into a file, not compiled")
+        # pycache requires python 3
+        from srcgen.pycache import compile_source
+        if filename is None:
+            filename = "<%s>" % (self._name or "srcgen",)
+        return compile_source(self.render().encode("utf-8"), filename, cache_dir, optimize)
+    
+    def dump(self, filename_or_fileobj, only_if_changed = False, compression = "infer", pyc = False):
+        """See :func:`BaseModule.dump <srcgen.base.BaseModule.dump>`. If ``pyc`` is given, the
+        module is written in UTF-8 along with its (hash-based) ``.pyc`` in ``__pycache__``, so 
+        importing it doesn't compile it, for as long as the text doesn't change"""
+        if self._stats is not None:
+            return self._stats._dump(self, self._dump, filename_or_fileobj, only_if_changed, compression, pyc)
+        else:
+            return self._dump(filename_or_fileobj, only_if_changed, compression, pyc)
+    
+    def _dump(self, filename_or_fileobj, only_if_changed, compression, pyc = False):
+        if pyc:
+            if hasattr(filename_or_fileobj, "write") or (infer_compression(filename_or_fileobj) 
+                    if compression == "infer" else compression):
+                raise ValueError("pyc requires dumping into an uncompressed file")
+            from srcgen.pycache import write_pyc
+            text = self.render()
+            changed = dump_chunks(filename_or_fileobj, lambda: [text], only_if_changed, "utf-8")
+            changed = write_pyc(filename_or_fileobj, text.encode("utf-8"), only_if_changed = only_if_changed) or changed
+        else:
+            changed = BaseModule._dump(self, filename_or_fileobj, only_if_changed, compression)
+        if self._sidecars and not hasattr(filename_or_fileobj, "write"):
+            changed = self.write_sidecars(os.path.dirname(filename_or_fileobj), only_if_changed) or changed
+        return changed
+    
+    def dump_package(self, dirname, shard_size = 64 * 1024, only_if_changed = False, pyc = False, 
+            split_side_effects = False):
+        """Dumps the module as a package (into ``dirname``) whose top-level functions and classes 
+        are split into shards of about ``shard_size`` characters, which are imported only when
+        one of their names is first accessed (see :func:`srcgen.split.split_source`, also for
+        ``split_side_effects``). Shards
+        left over from a previous dump are removed. Returns whether any file has been written"""
+        # split requires python 3 (ast.AsyncFunctionDef, end_lineno)
+        from srcgen.split import split_source, stale_shards
+        init, shards = split_source(self.render(), shard_size, split_side_effects = split_side_effects)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if pyc:
+            from srcgen.pycache import write_pyc
+        changed = False
+        for name, text in [("__init__", init)] + shards:
+            filename = os.path.join(dirname, name + ".py")
+            changed = dump_chunks(filename, lambda: [text], only_if_changed, "utf-8") or changed
+            if pyc:
+                changed = write_pyc(filename, text.encode("utf-8"), only_if_changed = only_if_changed) or changed
+        for fn in stale_shards(os.listdir(dirname), "_shard", len(shards)):
+            os.remove(os.path.join(dirname, fn))
+            changed = True
+        return self.write_sidecars(dirname, only_if_changed) or changed
+    
     #
     # Suites
     #
     @contextmanager
     def suite(self, headline, *args):
         self.stmt(headline, *args)
-        prev = self._curr
-        self._curr = []
-        prev.append(self._curr)
-        yield
-        self._curr = prev
+        with self._indented(): yield
     def if_(self, cond, *args):
         return self.suite("if %s:" % (cond,), *args)
     def elif_(self, cond, *args):
@@ -95,6 +248,8 @@ class PythonModule(BaseModule):
     def cython(self):
         mod = CythonModule()
         mod._curr = self._curr
+        mod._cache_render = self._cache_render
+        mod._sidecars = self._sidecars
         yield mod
 
     def method(self, name, *args):
@@ -186,43 +341,107 @@ class CythonModule(PythonModule):
 
 class P(object):
     """
-    Pickled object
+    Pickled object. ``protocol`` is the pickle protocol (e.g., ``pickle.HIGHEST_PROTOCOL``, 
+    which is far more compact for large tables). If ``compress`` is given, the pickle is 
+    zlib-compressed and embedded as a base64 string, so the generated module has to import
+    ``zlib`` and ``base64`` besides ``pickle``. For really large objects, see 
+    :func:`PythonModule.sidecar`
     """
     __slots__ = ["data"]
-    def __init__(self, obj):
-        self.data = "pickle.loads(%r)" % (pickle.dumps(obj),)
+    def __init__(self, obj, protocol = None, compress = False):
+        data = pickle.dumps(obj, protocol)
+        if compress:
+            blob = base64.b64encode(zlib.compress(data, 9)).decode("ascii")
+            self.data = "pickle.loads(zlib.decompress(base64.b64decode(%r)))" % (blob,)
+        else:
+            self.data = "pickle.loads(%r)" % (data,)
     def __str__(self):
         return self.data
     __repr__ = __str__
 
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    elif isinstance(value, six.integer_types):
+        return value if value.bit_length() <= 1024 else None
+    elif isinstance(value, float):
+        return value if not math.isinf(value) and not math.isnan(value) else None
+    return None
+
+def _int_op(func):
+    def fold(a, b):
+        if isinstance(a, float) or isinstance(b, float):
+            return None
+        return _number(func(a, b))
+    return fold
+
+def _fold_pow(a, b):
+    if isinstance(b, six.integer_types) and not 0 <= b <= 64:
+        return None
+    return _number(a ** b)
+
+def _fold_lshift(a, b):
+    return _int_op(operator.lshift)(a, b) if isinstance(b, six.integer_types) and b <= 1024 else None
+
 class E(BaseE):
     __slots__ = []
+    _FOLD_OPS = {
+        "+" : lambda a, b: _number(a + b),
+        "-" : lambda a, b: _number(a - b),
+        "*" : lambda a, b: _number(a * b),
+        "/" : lambda a, b: _number(a / b),
+        "//" : lambda a, b: _number(a // b),
+        "%" : lambda a, b: _number(a % b),
+        "**" : _fold_pow,
+        "<<" : _fold_lshift,
+        ">>" : _int_op(operator.rshift),
+        "^" : _int_op(operator.xor),
+        "|" : _int_op(operator.or_),
+        "&" : _int_op(operator.and_),
+    }
+    _FOLD_UNARY = {
+        "-" : lambda a: -a,
+        "+" : lambda a: a,
+        "~" : lambda a: None if isinstance(a, float) else ~a,
+    }
+    
+    @staticmethod
+    def _fold_literal(text):
+        try:
+            return int(text, 0)
+        except ValueError:
+            pass
+        try:
+            return _number(float(text))
+        except ValueError:
+            return None
     
     def __floordiv__(self, other):
-        return E("(%r // %r)" % (self, other))
+        return self._binop(self, " // ", other)
     def __or__(self, other):
-        return E("(%r or %r)" % (self, other))
+        return self._binop(self, " or ", other)
     def __and__(self, other):
-        return E("(%r and %r)" % (self, other))
+        return self._binop(self, " and ", other)
     def __rfloordiv__(self, other):
-        return E("(%r // %r)" % (other, self))
+        return self._binop(other, " // ", self)
     def __ror__(self, other):
-        return E("(%r or %r)" % (other, self))
+        return self._binop(other, " or ", self)
     def __rand__(self, other):
-        return E("(%r and %r)" % (other, self))
+        return self._binop(other, " and ", self)
     
     def __inv__(self):
-        return E("not %r" % (self,))
+        return self._node("not ", self)
     __invert__ = __inv__
     
     def __call__(self, *args, **kwargs):
-        textargs = ""
-        if args:
-            textargs += ", ".join(repr(a) for a in args)
-        if kwargs:
-            if args:
-                textargs += ", "
-            textargs += ",".join("%s = %r" % (k, v) for k, v in kwargs.items())
-        return E("%r(%s)" % (self, textargs))
+        pieces = [self, "("]
+        for a in args:
+            pieces.extend((_operand(a), ", "))
+        for k, v in kwargs.items():
+            pieces.extend(("%s = " % (k,), _operand(v), ","))
+        if len(pieces) > 2:
+            pieces.pop()
+        pieces.append(")")
+        return self._node(*pieces)
 
 
@@ -0,0 +1,239 @@
+"""
+Splitting a (huge) generated Python module into a package whose top-level functions and classes
+live in shards (submodules) that are only imported when one of their names is first accessed
+(through a module-level ``__getattr__``, PEP 562). Usually used through
+:func:`PythonModule.dump_package <srcgen.python.PythonModule.dump_package>`
+"""
+import ast
+import re
+
+
+_DEFS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+_SCOPES = _DEFS + (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+_SHARD_NAME = re.compile(r"^(?P<prefix>\w+?)(?P<index>\d+)\.py$")
+
+_LOADER = '''
+_srcgen_shards = %r
+
+def __getattr__(name):
+    try:
+        shard = _srcgen_shards[name]
+    except KeyError:
+        raise AttributeError("module %%r has no attribute %%r" %% (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module("." + shard, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_srcgen_shards))
+'''
+_RESERVED = frozenset(["_srcgen_shards", "__getattr__", "__dir__"])
+
+
+def _bound_names(stmt):
+    """The names that a top-level statement binds in the module's namespace"""
+    if isinstance(stmt, _DEFS):
+        return set([stmt.name])
+    names = set()
+    stack = [stmt]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, _DEFS):
+            names.add(node.name)
+            continue
+        if isinstance(node, _SCOPES):
+            continue
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, ast.alias):
+            if node.name != "*":
+                names.add(node.asname or node.name.split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        stack.extend(ast.iter_child_nodes(node))
+    return names
+
+def _referenced_names(node):
+    return set(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+
+def _definition_time_nodes(stmt, lazy_annotations):
+    """The parts of a ``def``/``class`` that are evaluated when it's executed, rather than
+    when the function is called"""
+    nodes = list(stmt.decorator_list)
+    if isinstance(stmt, ast.ClassDef):
+        nodes.extend(stmt.bases)
+        nodes.extend(stmt.keywords)
+        for child in stmt.body:
+            if isinstance(child, _DEFS):
+                nodes.extend(_definition_time_nodes(child, lazy_annotations))
+            else:
+                nodes.append(child)
+    else:
+        args = stmt.args
+        nodes.extend(args.defaults)
+        nodes.extend(d for d in args.kw_defaults if d is not None)
+        if not lazy_annotations:
+            all_args = args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg]
+            nodes.extend(a.annotation for a in all_args if a is not None and a.annotation is not None)
+            if stmt.returns is not None:
+                nodes.append(stmt.returns)
+    return nodes
+
+def _has_side_effects(stmt):
+    """Whether defining the function or class may have effects besides binding its name (e.g.,
+    registering it somewhere): it's decorated, or it's a class with a metaclass, keywords or
+    bases (whose ``__init_subclass__`` may do anything)"""
+    if stmt.decorator_list:
+        return True
+    if isinstance(stmt, ast.ClassDef):
+        return bool(stmt.keywords) or any(not (isinstance(b, ast.Name) and b.id == "object") for b in stmt.bases)
+    return False
+
+def _has_global(stmt):
+    return any(isinstance(n, (ast.Global, ast.Nonlocal)) for n in ast.walk(stmt))
+
+def _import_lines(names):
+    return ["from . import %s\n" % (name,) for name in sorted(names)]
+
+
+class _Group(object):
+    __slots__ = ["stmts", "text", "bound", "refs", "shardable"]
+    def __init__(self, stmts, text):
+        self.stmts = stmts
+        self.text = text
+        self.bound = set()
+        self.refs = set()
+        for stmt in stmts:
+            self.bound.update(_bound_names(stmt))
+            self.refs.update(_referenced_names(stmt))
+        self.shardable = False
+
+
+def split_source(source, shard_size = 64 * 1024, prefix = "_shard", split_side_effects = False):
+    """
+    Splits the given Python source into the text of a package's ``__init__`` and a list of
+    ``(name, text)`` shards. Consecutive top-level functions and classes are put into shards of
+    about ``shard_size`` characters (each shard holds at least one); the ``__init__`` keeps the
+    rest of the module, in its original order, and imports a shard when one of its names is
+    first accessed. Shards import the names they use from the package: names needed to define
+    their functions and classes (e.g., base classes and decorators) at the top, and names that
+    are only used by function bodies at the bottom, so shards can refer to each other.
+
+    A function or class stays in the ``__init__`` if top-level code refers to it (along with
+    everything it refers to), if its name is bound more than once, or if it uses ``global``.
+    So do decorated functions and classes, and classes with bases (other than ``object``) or
+    keywords (e.g., a metaclass), since defining them may have side effects, such as registering
+    them, that must happen on import; ``split_side_effects`` puts them into shards as well.
+    Note that shards see other module-level names as they were when the shard was imported
+    """
+    tree = ast.parse(source)
+    lines = source.splitlines(True)
+    for stmt in tree.body:
+        if isinstance(stmt, ast.ImportFrom) and stmt.level:
+            raise ValueError("modules with relative imports can't be split (line %d)" % (stmt.lineno,))
+
+    # each group spans from the end of the previous one, so comments and blank lines go with
+    # the statement that follows them; statements that share a line are kept together
+    groups = []
+    start = 0
+    pending = []
+    for i, stmt in enumerate(tree.body):
+        pending.append(stmt)
+        end = stmt.end_lineno
+        if i + 1 < len(tree.body) and tree.body[i + 1].lineno <= end:
+            continue
+        groups.append(_Group(pending, "".join(lines[start:end])))
+        start = end
+        pending = []
+    tail = "".join(lines[start:])
+
+    future = [g.text for g in groups if isinstance(g.stmts[0], ast.ImportFrom) and g.stmts[0].module == "__future__"]
+    lazy_annotations = any(a.name == "annotations" for g in groups for s in g.stmts
+        if isinstance(s, ast.ImportFrom) and s.module == "__future__" for a in s.names)
+    star_imports = [g.text.strip() + "\n" for g in groups
+        if any(isinstance(s, ast.ImportFrom) and s.names[0].name == "*" for s in g.stmts)]
+
+    counts = {}
+    for g in groups:
+        for name in g.bound:
+            counts[name] = counts.get(name, 0) + 1
+    if _RESERVED.intersection(counts):
+        raise ValueError("the module defines one of %s" % (", ".join(sorted(_RESERVED)),))
+    by_name = {}
+    for g in groups:
+        stmt = g.stmts[0]
+        if (len(g.stmts) == 1 and isinstance(stmt, _DEFS) and counts[stmt.name] == 1 and
+                not (stmt.name.startswith("__") and stmt.name.endswith("__")) and not _has_global(stmt) and (split_side_effects or not _has_side_effects(stmt))):
+            g.shardable = True
+            by_name[stmt.name] = g
+
+    # whatever the module's own top-level code refers to must be there when it runs
+    todo = [g for g in groups if not g.shardable]
+    while todo:
+        g = todo.pop()
+        for name in g.refs:
+            other = by_name.get(name)
+            if other is not None and other.shardable:
+                other.shardable = False
+                todo.append(other)
+
+    shards = []
+    size = shard_size
+    for g in groups:
+        if not g.shardable:
+            continue
+        if size >= shard_size:
+            shards.append([])
+            size = 0
+        shards[-1].append(g)
+        size += len(g.text)
+
+    top_level = set(counts)
+    owner = {}
+    texts = []
+    for i, shard in enumerate(shards):
+        name = "%s%d" % (prefix, i)
+        for g in shard:
+            owner[g.stmts[0].name] = name
+    for i, shard in enumerate(shards):
+        name = "%s%d" % (prefix, i)
+        bound = set()
+        early = set()
+        refs = set()
+        for g in shard:
+            bound.update(g.bound)
+            refs.update(g.refs)
+            for node in _definition_time_nodes(g.stmts[0], lazy_annotations):
+                early.update(_referenced_names(node))
+        refs = (refs & top_level) - bound
+        # names of the __init__ are all there by the time a shard is imported
+        early = (early & refs) | set(n for n in refs if n not in owner)
+        late = refs - early
+        parts = future + star_imports + _import_lines(early)
+        if parts and not shard[0].text.startswith("\n"):
+            parts.append("\n")
+        parts.extend(g.text if g.text.endswith("\n") else g.text + "\n" for g in shard)
+        if late:
+            parts.append("\n# imported last, so that shards can refer to each other\n")
+            parts.extend(_import_lines(late))
+        texts.append((name, "".join(parts)))
+
+    init = [g.text for g in groups if not g.shardable]
+    init.append(tail)
+    if owner:
+        init.append("\n" if "".join(init).endswith("\n") else "\n\n")
+        if "__all__" not in counts and not star_imports:
+            public = sorted(n for n in counts if not n.startswith("_"))
+            init.append("__all__ = %r\n" % (public,))
+        init.append(_LOADER % (dict(sorted(owner.items())),))
+    return "".join(init), texts
+
+def stale_shards(filenames, prefix, count):
+    """Returns the shard files (among ``filenames``) that aren't one of the ``count`` current ones"""
+    stale = []
+    for fn in filenames:
+        m = _SHARD_NAME.match(fn)
+        if m and m.group("prefix") == prefix and int(m.group("index")) >= count:
+            stale.append(fn)
+    return stale
@@ -0,0 +1,130 @@
+import json
+from timeit import default_timer
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class RenderStats(object):
+    """
+    Statistics gathered by an instrumented module or document (see :func:`Instrumented.instrument`).
+    ``suites`` counts nested suites (elements, for HTML documents), ``output_size`` is the length
+    of the last rendered text, the ``*_time`` fields accumulate seconds spent in each phase (the
+    build phase being the time between renders) and ``peak_memory`` is the tracemalloc peak
+    observed while rendering, if memory tracing was asked for.
+
+    The ``callback``, if given, is invoked as ``callback(event, obj, stats)`` where ``event`` is
+    one of ``"render_start"``, ``"render_end"``, ``"dump_start"`` or ``"dump_end"``
+    """
+    FIELDS = ["name", "lines", "suites", "max_depth", "output_size", "renders", "dumps",
+        "build_time", "render_time", "dump_time", "peak_memory"]
+
+    def __init__(self, name = None, callback = None, trace_memory = False):
+        self.name = name
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.lines = 0
+        self.suites = 0
+        self.max_depth = 0
+        self.output_size = 0
+        self.renders = 0
+        self.dumps = 0
+        self.build_time = 0.0
+        self.render_time = 0.0
+        self.dump_time = 0.0
+        self.peak_memory = None
+        self._build_start = default_timer()
+
+    def __repr__(self):
+        return "RenderStats(%s)" % (", ".join("%s = %r" % (k, getattr(self, k)) for k in self.FIELDS),)
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.FIELDS)
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def _fire(self, event, obj):
+        if self.callback is not None:
+            self.callback(event, obj, self)
+
+    def _render(self, obj, chunks):
+        t0 = default_timer()
+        self.build_time += t0 - self._build_start
+        self.suites, self.max_depth = obj._structure()
+        self._fire("render_start", obj)
+        started_tracing = False
+        if self.trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        lines = 0
+        size = 0
+        try:
+            for chunk in chunks:
+                lines += chunk.count("\n")
+                size += len(chunk)
+                yield chunk
+            if self.trace_memory and tracemalloc is not None and tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak_memory = peak if self.peak_memory is None else max(peak, self.peak_memory)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        self.lines = lines
+        self.output_size = size
+        self.renders += 1
+        t1 = default_timer()
+        self.render_time += t1 - t0
+        self._build_start = t1
+        self._fire("render_end", obj)
+
+    def _dump(self, obj, func, *args):
+        self._fire("dump_start", obj)
+        t0 = default_timer()
+        res = func(*args)
+        self.dump_time += default_timer() - t0
+        self.dumps += 1
+        self._fire("dump_end", obj)
+        return res
+
+
+def aggregate(stats):
+    """Combines several stats (as returned by :func:`RenderStats.to_dict`, e.g., the ``stats``
+    of a :func:`Project.dump <srcgen.project.Project.dump>`'s results) into a single dict.
+    Counters and times are summed while ``max_depth`` and ``peak_memory`` are maximized"""
+    total = dict((k, 0) for k in RenderStats.FIELDS if k != "name")
+    total["modules"] = 0
+    total["peak_memory"] = None
+    for st in stats:
+        if st is None:
+            continue
+        total["modules"] += 1
+        for k, v in st.items():
+            if k == "name" or v is None:
+                continue
+            elif k in ("max_depth", "peak_memory"):
+                total[k] = v if total[k] is None else max(total[k], v)
+            else:
+                total[k] += v
+    return total
+
+
+class Instrumented(object):
+    """
+    Mixin for objects that can be instrumented. Until :func:`instrument` is called, the
+    instrumentation costs nothing beyond a single check per render
+    """
+    __slots__ = []
+
+    def instrument(self, callback = None, trace_memory = False, name = None):
+        """Starts gathering statistics on this object, returning the :class:`RenderStats`"""
+        self._stats = RenderStats(name, callback, trace_memory)
+        return self._stats
+    def uninstrument(self):
+        self._stats = None
+    @property
+    def stats(self):
+        return self._stats
+
+    def _structure(self):
+        """Returns the number of suites and the maximal depth"""
+        raise NotImplementedError()
@@ -0,0 +1,101 @@
+from __future__ import with_statement
+import os
+import shutil
+import ctypes
+import tempfile
+import unittest
+from srcgen.python import CythonModule
+from srcgen.c import CModule, HModule
+from srcgen.build import build_cython, build_library, compile_library, BuildError
+try:
+    import Cython
+except ImportError:
+    Cython = None
+
+
+class TestBuild(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def artifacts(self, kind):
+        root = os.path.join(self.cache_dir, kind)
+        return sorted(os.path.join(dirpath, fn) for dirpath, _, filenames in os.walk(root) for fn in filenames)
+
+    @unittest.skipIf(Cython is None, "requires Cython")
+    def test_cython(self):
+        pxd = CythonModule()
+        with pxd.cdef.struct("point"):
+            pxd.stmt("double x")
+            pxd.stmt("double y")
+        pyx = CythonModule()
+        pyx.stmt("from geom cimport point")
+        with pyx.def_("norm2", "double x", "double y"):
+            pyx.cdef.stmt("point p")
+            pyx.stmt("p.x, p.y = x, y")
+            pyx.return_("p.x * p.x + p.y * p.y")
+        other = CythonModule()
+        with other.def_("twice", "int x"):
+            other.return_("x * 2")
+        
+        exts = [("srcgen_geom", pyx, {"geom" : pxd}), ("srcgen_other", other)]
+        geom, mod = build_cython(exts, self.cache_dir, workers = 2)
+        self.assertEqual((geom.norm2(3, 4), mod.twice(21)), (25.0, 42))
+        built = self.artifacts("cython")
+        self.assertEqual(len(built), 2)
+        mtimes = [os.path.getmtime(fn) for fn in built]
+        build_cython(exts, self.cache_dir)
+        self.assertEqual([os.path.getmtime(fn) for fn in built], mtimes)
+        build_cython(exts[1:], self.cache_dir, extra_compile_args = ["-O1"])
+        self.assertEqual(len(self.artifacts("cython")), 3)
+        self.assertRaises(TypeError, build_cython, exts, self.cache_dir, sources = ["x.c"])
+
+    def kernels(self, scale):
+        h = HModule("KERNELS_H")
+        h.stmt("double dot(const double * a, const double * b, int n)")
+        h.stmt("double scaled(double x)")
+        dot = CModule()
+        dot.include("kernels.h")
+        with dot.func("double", "dot", "const double * a", "const double * b", "int n"):
+            dot.stmt("double total = 0")
+            with dot.for_("int i = 0", "i < n", "i++"):
+                dot.stmt("total += a[i] * b[i]")
+            dot.return_("total")
+        scale_mod = CModule()
+        scale_mod.include("kernels.h")
+        with scale_mod.func("double", "scaled", "double x"):
+            scale_mod.return_("x * %d" % (scale,))
+        return {"dot.c" : dot, "scale.c" : scale_mod}, {"kernels.h" : h}
+
+    @unittest.skipIf(shutil.which(os.environ.get("CC", "cc")) is None, "requires a C compiler")
+    def test_library(self):
+        sources, headers = self.kernels(3)
+        lib = build_library(sources, headers, "kernels", cache_dir = self.cache_dir, workers = 2)
+        lib.dot.restype = lib.scaled.restype = ctypes.c_double
+        lib.dot.argtypes = [ctypes.POINTER(ctypes.c_double)] * 2 + [ctypes.c_int]
+        lib.scaled.argtypes = [ctypes.c_double]
+        a = (ctypes.c_double * 3)(1, 2, 3)
+        self.assertEqual((lib.dot(a, a, 3), lib.scaled(1.5)), (14.0, 4.5))
+        
+        built = self.artifacts("c")
+        self.assertEqual([os.path.basename(fn) for fn in built if fn.endswith(".so")], ["libkernels.so"])
+        self.assertEqual(len(built), 3)
+        mtimes = [os.path.getmtime(fn) for fn in built]
+        self.assertEqual(compile_library(sources, headers, "kernels", cache_dir = self.cache_dir), 
+            [fn for fn in built if fn.endswith(".so")][0])
+        self.assertEqual([os.path.getmtime(fn) for fn in built], mtimes)
+        # only the translation unit that has changed is compiled again
+        sources, headers = self.kernels(4)
+        lib = build_library(sources, headers, "kernels", cache_dir = self.cache_dir)
+        self.assertEqual(len(self.artifacts("c")), 5)
+        self.assertTrue(all(os.path.getmtime(fn) == t for fn, t in zip(built, mtimes)))
+        
+        bad = CModule()
+        bad.stmt("int f(void) { return undefined_name; }")
+        self.assertRaises(BuildError, build_library, {"bad.c" : bad}, cache_dir = self.cache_dir)
+        self.assertEqual([fn for fn in os.listdir(os.path.join(self.cache_dir, "c")) if fn.startswith(".")], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
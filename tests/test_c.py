@@ -1,6 +1,6 @@
 from __future__ import with_statement
 import unittest
-from srcgen.c import CModule, E
+from srcgen.c import CModule, HModule, E
 
 
 class TestC(unittest.TestCase):
@@ -64,6 +64,103 @@ int main(int argv, const char ** argc) {
 """
         self.assertEqual(str(m), output)
 
+    def test_header(self):
+        m = HModule("FOO_H")
+        with m.struct("foo"):
+            m.stmt("int x")
+        output = """\
+#ifndef FOO_H
+#define FOO_H
+
+struct foo {
+    int x;
+};
+
+#endif /* FOO_H */
+"""
+        self.assertEqual(m.render(), output)
+        self.assertEqual("".join(m.iter_chunks(1)), output)
+
+    def build(self, m):
+        m.comment("compact", box = True)
+        m.include("<stdio.h>")
+        with m.IFDEF("FOO"):
+            m.define("BAR", "1")
+        with m.ELSE(""):
+            m.define("BAR", "2")
+        with m.enum("colors"):
+            for name in ["red", "green", "blue"]:
+                m.enum_member(name)
+        for i in range(100):
+            m.comment("function %d" % (i,))
+            with m.func("int", "f%d" % (i,), "int x"):
+                with m.switch("x"):
+                    with m.case(1):
+                        m.return_(i)
+                    with m.default():
+                        m.return_(-i)
+        return m
+
+    def test_compact(self):
+        plain = self.build(CModule())
+        compact = self.build(CModule(compact = True))
+        self.assertEqual(compact.render(), plain.render())
+        self.assertTrue(compact.memory_footprint() < plain.memory_footprint())
+        self.assertEqual(self.build(HModule("X_H", compact = True)).render(), 
+            self.build(HModule("X_H")).render())
+
+    def test_fragments(self):
+        def epilogue(m):
+            m.stmt("free(buf)")
+            with m.if_("fd >= 0"):
+                m.stmt("close(fd)")
+            m.return_("rc")
+        
+        for compact in (False, True):
+            m = CModule(compact = compact)
+            expected = CModule()
+            with m.fragment() as frag:
+                epilogue(m)
+            self.assertEqual(m.render(), "\n")
+            for mod in (m, expected):
+                with mod.func("int", "foo", "int fd"):
+                    with mod.if_("fd < 0"):
+                        if mod is m:
+                            m.insert(frag)
+                        else:
+                            epilogue(mod)
+                    mod.stmt("rc = 0")
+                    if mod is m:
+                        m.insert(frag)
+                    else:
+                        epilogue(mod)
+            self.assertEqual(m.render(), expected.render())
+            self.assertEqual(m.render(), expected.render())
+    
+    def test_nested_fragments(self):
+        m = CModule(cache_render = True)
+        with m.fragment() as inner:
+            with m.if_("x"):
+                m.stmt("y = 1")
+        with m.fragment() as outer:
+            with m.while_("z"):
+                m.insert(inner)
+            m.insert(inner)
+        with m.func("void", "foo"):
+            m.insert(outer)
+        self.assertEqual(m.render(), """\
+void foo() {
+    while z:
+        if (x) {
+            y = 1;
+        }
+    }
+    if (x) {
+        y = 1;
+    }
+}
+""")
+
 
 if __name__ == "__main__":
     unittest.main()
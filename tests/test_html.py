@@ -1,6 +1,11 @@
 from __future__ import with_statement
+import os
+import gzip
+import shutil
+import tempfile
 import unittest
-from srcgen.html import HtmlDocument
+from io import BytesIO
+from srcgen.html import HtmlDocument, CSS, xml_escape, xml_escape_many
 from srcgen.js import JS
 
 
@@ -150,6 +155,149 @@ with newl&lt;i&gt;nes&nbsp;
     </head>
 </html>""")        
 
+    def test_escape(self):
+        self.assertEqual(xml_escape("""<a href="x">'Q' & A</a>"""), 
+            "&lt;a href=&quot;x&quot;&gt;&apos;Q&apos; &amp; A&lt;/a&gt;")
+        self.assertEqual(xml_escape("&lt;"), "&amp;lt;")
+        self.assertEqual(xml_escape(None), "")
+        self.assertEqual(xml_escape(5), "5")
+        texts = ["a<b", None, "", "plain", "x\0&y", 7]
+        self.assertEqual(xml_escape_many(texts), [xml_escape(t) for t in texts])
+        self.assertEqual(xml_escape_many(texts[:-2]), [xml_escape(t) for t in texts[:-2]])
+        self.assertEqual(xml_escape_many([]), [])
+
+    def test_iter_render(self):
+        doc = HtmlDocument()
+        with doc.body():
+            with doc.table():
+                for i in range(200):
+                    with doc.tr():
+                        doc.td("cell <%d>" % (i,))
+                        doc.td(i, class_ = "num")
+        text = doc.render("  ")
+        chunks = list(doc.iter_render("  ", chunk_size = 100))
+        self.assertTrue(len(chunks) > 10)
+        self.assertEqual("".join(chunks), text)
+        f = BytesIO()
+        doc.render_to(f, "  ", encoding = "utf-8")
+        self.assertEqual(f.getvalue(), text.encode("utf-8"))
+
+    def test_compact_elements(self):
+        doc = HtmlDocument()
+        with doc.body():
+            with doc.div() as div:
+                br = doc.br()
+                span = doc.span("hi")
+                doc.attrs(id = "main")
+        self.assertIs(br.doc, span.doc)
+        self.assertIsNone(br._attrs)
+        self.assertIsNone(br._elements)
+        self.assertEqual(div.attrs, {"id" : "main"})
+        self.assertIs(span.tag, doc.span().tag)
+        self.assertEqual(doc.render(""), doc.DOCTYPE + 
+            '\n<html xmlns="http://www.w3.org/1999/xhtml">\n<body>\n<div id="main">\n<br/><span>hi</span>\n</div>\n</body>\n<span/>\n</html>')
+        # attrs and elements are still there to be changed directly
+        br.attrs["id"] = "z"
+        br.elements.append("t")
+        span.elements = ["bye"]
+        self.assertEqual(doc.render(""), doc.DOCTYPE + 
+            '\n<html xmlns="http://www.w3.org/1999/xhtml">\n<body>\n<div id="main">\n<br id="z">t</br><span>bye</span>\n</div>\n</body>\n<span/>\n</html>')
+
+    def test_attrs_cache(self):
+        doc = HtmlDocument()
+        with doc.body():
+            div = doc.div(class_ = "a", data_role = "x<y", hidden = True, _private = 1, gone = None)
+        self.assertEqual(div._format_attrs(), ' class="a" data-role="x&lt;y" hidden')
+        self.assertIsNot(div._format_attrs(), div._format_attrs())
+        doc.freeze_attrs()
+        self.assertIs(div._format_attrs(), div._format_attrs())
+        with div:
+            doc.attrs(class_ = "b")
+        self.assertEqual(div._format_attrs(), ' class="b" data-role="x&lt;y" hidden')
+        div.freeze_attrs()
+        div.attrs["class"] = "c"
+        self.assertEqual(div._format_attrs(), ' class="b" data-role="x&lt;y" hidden class="c"')
+
+    def test_css_grouped(self):
+        def build(css):
+            with css("div"):
+                with css("a", "a:hover", "a:visited"):
+                    with css(".foo", "> p"):
+                        css["background_color"] = "black"
+                    css["color"] = "#aabbcc"
+            return ["  " * level + line for level, _, line in css.render_html()]
+        self.assertEqual(build(CSS()), [
+            "div {", "}",
+            "div a {", "  color: #aabbcc;", "}",
+            "div a:hover {", "  color: #aabbcc;", "}",
+            "div a:visited {", "  color: #aabbcc;", "}",
+            "div a.foo {", "  background-color: black;", "}",
+            "div a> p {", "  background-color: black;", "}",
+            "div a:hover.foo {", "  background-color: black;", "}",
+            "div a:hover> p {", "  background-color: black;", "}",
+            "div a:visited.foo {", "  background-color: black;", "}",
+            "div a:visited> p {", "  background-color: black;", "}",
+        ])
+        self.assertEqual(build(CSS(grouped = True)), [
+            "div {", "}",
+            "div a, div a:hover, div a:visited {", "  color: #aabbcc;", "}",
+            "div a.foo, div a> p, div a:hover.foo, div a:hover> p, div a:visited.foo, div a:visited> p {", 
+                "  background-color: black;", "}",
+        ])
+
+    def test_minify(self):
+        doc = HtmlDocument()
+        css = doc.head_css()
+        with css("div"):
+            css["margin"] = 0
+            with css("a", "a:hover"):
+                css["color"] = "red"
+        with doc.head():
+            with doc.script():
+                m = JS()
+                m.comment("handler")
+                with m.func("f", "a"):
+                    m.var("x", 1)
+                    # no lines: nothing is emitted (and the previous line is kept)
+                    m.comment()
+                    with m.if_("a < x"):
+                        m.return_("a")
+                    m.comment("fallback", box = True)
+                    m.return_("x")
+                doc.text(m)
+        with doc.body():
+            doc.comment("not rendered")
+            with doc.div(class_ = "x"):
+                doc.pre("  keep\n    this  ")
+                doc.textarea("  and  this ")
+                doc.raw("<b> raw </b>")
+        self.assertEqual(doc.render(minify = True), 
+            doc.DOCTYPE + '<html xmlns="http://www.w3.org/1999/xhtml"><head><style type="text/css">'
+            'div{margin:0}div a{color:red}div a:hover{color:red}</style><script type="text/javascript">'
+            'function f(a) {var x = 1;if (a &lt; x) {return a;}\nreturn x;}</script></head><body>'
+            '<div class="x"><pre>  keep\n    this  </pre><textarea>  and  this </textarea><b> raw </b></div>'
+            '</body></html>')
+        self.assertEqual(b"".join(doc.iter_render(chunk_size = 10, encoding = "utf8", minify = True)),
+            doc.render(minify = True).encode("utf8"))
+        self.assertEqual(list(css.render_html(minify = True))[0], (0, False, "div{margin:0}"))
+
+    def test_compressed(self):
+        doc = HtmlDocument()
+        with doc.body():
+            for i in range(100):
+                doc.p("paragraph %d" % (i,))
+        text = doc.render().encode("utf-8")
+        chunks = list(doc.iter_render(chunk_size = 100, compression = "gzip"))
+        self.assertEqual(gzip.decompress(b"".join(chunks)), text)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "index.html.gz")
+            self.assertTrue(doc.dump(filename, only_if_changed = True))
+            self.assertFalse(doc.dump(filename, only_if_changed = True))
+            with gzip.open(filename) as f:
+                self.assertEqual(f.read(), text)
+        finally:
+            shutil.rmtree(tmpdir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+from __future__ import with_statement
+import sys
+import inspect
+import unittest
+from srcgen.python import PythonModule, E
+from srcgen.importer import ModuleImporter
+
+
+class TestImporter(unittest.TestCase):
+    def setUp(self):
+        self.importer = ModuleImporter()
+        self.importer.install()
+    def tearDown(self):
+        self.importer.uninstall()
+        for name in list(sys.modules):
+            if name.split(".")[0] in ("gen_mod", "gen_pkg"):
+                del sys.modules[name]
+
+    def test_module(self):
+        m = PythonModule("gen_mod")
+        with m.def_("twice", "x"):
+            m.return_(E("x") * 2)
+        self.importer.register(m)
+        self.assertRaises(ValueError, self.importer.register, m)
+        # nothing is rendered before the import
+        m.stmt("VALUE = 7")
+        import gen_mod
+        self.assertEqual((gen_mod.twice(21), gen_mod.VALUE), (42, 7))
+        self.assertIn("return (x * 2)", inspect.getsource(gen_mod.twice))
+
+    def test_package(self):
+        pkg = self.importer.register(PythonModule("gen_pkg.sub"), package = True)
+        pkg.stmt("from . import leaf")
+        pkg.stmt("NAME = __name__")
+        leaf = self.importer.register(PythonModule("gen_pkg.sub.leaf"))
+        leaf.stmt("X = 1")
+        import gen_pkg.sub
+        self.assertEqual(gen_pkg.sub.NAME, "gen_pkg.sub")
+        self.assertEqual(gen_pkg.sub.leaf.X, 1)
+        self.assertEqual(list(gen_pkg.__path__), [])
+        self.assertRaises(ImportError, __import__, "gen_pkg.missing")
+
+    def test_unregister(self):
+        self.importer.register(PythonModule("gen_pkg.a.x"))
+        self.importer.register(PythonModule("gen_pkg.a.y"))
+        self.assertTrue(self.importer.is_package("gen_pkg.a"))
+        self.importer.unregister("gen_pkg.a.x")
+        self.assertTrue(self.importer.is_package("gen_pkg"))
+        self.importer.unregister("gen_pkg.a.y")
+        self.assertFalse(self.importer.is_package("gen_pkg.a"))
+        self.assertIsNone(self.importer.find_spec("gen_pkg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
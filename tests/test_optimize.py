@@ -0,0 +1,96 @@
+from __future__ import with_statement
+import unittest
+from srcgen.c import CModule, E as CE
+from srcgen.python import PythonModule, E
+from srcgen.optimize import optimize
+
+
+class TestOptimize(unittest.TestCase):
+    def test_c(self):
+        m = CModule()
+        a, i, k = CE("a"), CE("i"), CE("k")
+        with m.func("double", "f", "double * a", "int i", "double k"):
+            x, y = m.optimize("double", a[i] * k + CE(2) * 4, CE("sqrt")(a[i] * k) - (CE(7) / 2 << 1))
+            m.return_(x * y)
+        self.assertEqual(m.render(), """\
+double f(double * a, int i, double k) {
+    double _t0 = (a[i] * k);
+    return ((_t0 + 8) * (sqrt(_t0) - 6));
+}
+""")
+        # no folding of floats, of negative division or of results that overflow an int
+        self.assertEqual([str(e) for e in m.optimize("int", CE(1.5) * 2, CE(-7) / 2, CE(2 ** 30) * 4)],
+            ["(1.5 * 2)", "(-7 / 2)", "(1073741824 * 4)"])
+
+    def test_python(self):
+        m = PythonModule()
+        b = E("b")
+        exprs = m.optimize((b.x + 1) * (b.x + 1) + E(3) ** 2 / 4,
+            E("ok") & (b.y // 2), b.z * E("f")(b.y // 2), E("g")() + E("g")(), E("(p if q else r)"))
+        # (b.y // 2) is hoisted out of the "and" only because the call's argument needs it anyway
+        self.assertEqual([str(e) for e in exprs], ["((_t0 * _t0) + 2.25)", "(ok and _t1)",
+            "(b.z * f(_t1))", "(g() + g())", "(p if q else r)"])
+        self.assertEqual(m.render(), "_t0 = (b.x + 1)\n_t1 = (b.y // 2)\n")
+        exprs = m.optimize(E("ok") | b.w.v, b.w.v * b.w.v, prefix = "tmp")
+        self.assertEqual([str(e) for e in exprs], ["(ok or tmp2)", "(tmp2 * tmp2)"])
+        exprs = m.optimize(E("ok") | (b.w * 2), E("no") | (b.w * 2))
+        self.assertEqual([str(e) for e in exprs], ["(ok or (b.w * 2))", "(no or (b.w * 2))"])
+
+    def test_negative_literals(self):
+        m = PythonModule()
+        neg = E(0) - 5
+        exprs = m.optimize(neg ** E("n"), neg.real, neg[E("i")], neg(E("x")), neg * E("n"))
+        self.assertEqual([str(e) for e in exprs], ["((-5) ** n)", "(-5).real", "(-5)[i]", "(-5)(x)", "((-5) * n)"])
+        self.assertEqual(eval(str(exprs[0]), {"n" : 2}), 25)
+
+    def test_prefix_precedence(self):
+        # "not" binds looser than "+", and unary minus looser than "**"
+        a, x = E("a"), E("x")
+        for expr, env in [((~a + 1) * (~a + 2), {"a" : 0}), ((-x) ** 2 + (-x) ** 3, {"x" : 2}),
+                (-E(5) ** 2 + (E(0) - 5) ** 2, {})]:
+            m = PythonModule()
+            res, = m.optimize(expr)
+            ns = dict(env)
+            exec(m.render(), ns)
+            self.assertEqual(eval(str(res), ns), eval(str(expr), dict(env)))
+        self.assertEqual(str(res), "0")
+
+    def test_c_temporaries(self):
+        m = CModule()
+        i, x = CE("i"), CE("x")
+        exprs = m.optimize("double", CE("a")[i + 1] * CE("b")[i + 1], (x < 1) + (x < 1), ~CE(2 ** 31 - 1), -CE(5))
+        # neither subscripts nor comparisons are declared as doubles; ~INT_MAX isn't an int literal
+        self.assertEqual(m.render(), "\n")
+        self.assertEqual([str(e) for e in exprs], ["(a[(i + 1)] * b[(i + 1)])", "((x < 1) + (x < 1))",
+            "~2147483647", "-5"])
+
+    def test_c_members(self):
+        m = CModule()
+        p, q = CE("p"), CE("*q")
+        exprs = m.optimize("double", p.pos.x * p.pos.x + p.pos.y * p.pos.y, q * q + (p.w * 2) * (p.w * 2))
+        # neither p.pos nor *q is a double
+        self.assertEqual(m.render(), "double _t0 = (p.w * 2);\n")
+        self.assertEqual([str(e) for e in exprs], ["((p.pos.x * p.pos.x) + (p.pos.y * p.pos.y))",
+            "((*q * *q) + (_t0 * _t0))"])
+
+    def test_options(self):
+        expr = (E("a") * 2 + E(3) * 5) / (E("a") * 2)
+        temps, (res,) = optimize([expr], iter(["t"]), fold = False)
+        self.assertEqual([(name, str(e)) for name, e in temps], [("t", "(a * 2)")])
+        self.assertEqual(str(res), "((t + (3 * 5)) / t)")
+        temps, (res,) = optimize([expr], iter(["t"]), cse = False)
+        self.assertEqual((temps, str(res)), ([], "(((a * 2) + 15) / (a * 2))"))
+
+    def test_deep(self):
+        total = CE("x")
+        for i in range(20000):
+            total = total + CE("a")[CE("i")] * (CE(2) * 3)
+        m = CModule()
+        res, = m.optimize("int", total)
+        self.assertEqual(m.render(), "int _t0 = (a[i] * 6);\n")
+        self.assertEqual(str(res).count("x + _t0) + _t0) + _t0)"), 1)
+        self.assertEqual(str(res).count("_t0"), 20000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+from __future__ import with_statement
+import os
+import shutil
+import tempfile
+import unittest
+from srcgen.c import CModule, HModule
+from srcgen.python import PythonModule, E
+from srcgen.html import HtmlDocument
+from srcgen.project import Project
+
+
+class TestProject(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def build(self):
+        proj = Project(self.root)
+        for i in range(8):
+            h = proj.add("include/mod%d.h" % (i,), HModule("MOD%d_H" % (i,)))
+            h.stmt("int f%d(int x)" % (i,))
+            c = proj.add("src/mod%d.c" % (i,), CModule())
+            c.include("mod%d.h" % (i,))
+            with c.func("int", "f%d" % (i,), "int x"):
+                c.return_("x + %d" % (i,))
+            p = proj.add("py/mod%d.py" % (i,), PythonModule())
+            with p.def_("f%d" % (i,), "x"):
+                p.return_("x + %d" % (i,))
+        return proj
+
+    def check(self, proj, results):
+        self.assertEqual([r.path for r in results], sorted(proj))
+        for path in proj:
+            with open(os.path.join(self.root, path)) as f:
+                self.assertEqual(f.read(), proj[path].render())
+
+    def test_serial(self):
+        proj = self.build()
+        self.check(proj, proj.dump(workers = 1))
+
+    def test_parallel(self):
+        proj = self.build()
+        self.check(proj, proj.dump(workers = 3))
+
+    def test_only_if_changed(self):
+        proj = self.build()
+        results = proj.dump(workers = 2, only_if_changed = True)
+        self.assertTrue(all(r.changed for r in results))
+        proj["py/mod3.py"].stmt("x = 5")
+        results = proj.dump(workers = 2, only_if_changed = True)
+        self.assertEqual([r.path for r in results if r.changed], ["py/mod3.py"])
+        self.check(proj, results)
+
+    def test_html(self):
+        proj = self.build()
+        doc = proj.add("html/index.html", HtmlDocument())
+        with doc.body():
+            doc.p("hello")
+        self.assertEqual(len([r for r in proj.dump(workers = 2, only_if_changed = True) if r.changed]), 25)
+        self.assertEqual([r.path for r in proj.dump(workers = 2, only_if_changed = True) if r.changed], [])
+        with open(os.path.join(self.root, "html/index.html")) as f:
+            self.assertEqual(f.read(), doc.render())
+
+    def test_unpicklable(self):
+        proj = self.build()
+        events = []
+        proj["py/mod1.py"].instrument(lambda event, obj, stats: events.append(event))
+        proj["py/mod2.py"].stmt(E("a") + 1)
+        proj["py/mod2.py"].stmt(E("b").c[E("d") * 2])
+        results = proj.dump(workers = 2)
+        self.check(proj, results)
+        # dumped in this process, since the lambda can't be pickled
+        self.assertTrue(events)
+        self.assertEqual([r.path for r in results if r.stats is not None], ["py/mod1.py"])
+
+
+if __name__ == "__main__":
+    unittest.main()
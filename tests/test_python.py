@@ -1,6 +1,23 @@
 from __future__ import with_statement
+import os
+import bz2
+import base64
+import pickle
+import gzip
+import lzma
+import zlib
+import marshal
+import copy
+import importlib.util
+import shutil
+import tempfile
 import unittest
-from srcgen.python import PythonModule, R, E, CythonModule
+from io import BytesIO
+from six import StringIO
+from srcgen.python import PythonModule, R, E, P, CythonModule
+from srcgen import pycache
+from srcgen.base import enable_interning, disable_interning
+from srcgen.output import dump_chunks
 
 
 class TestPython(unittest.TestCase):
@@ -113,6 +130,253 @@ cdef extern from "myheader.h"
 """
         self.assertEqual(str(m), output)
 
+    def test_chunks(self):
+        m = PythonModule()
+        for i in range(50):
+            with m.def_("f%d" % (i,), "x"):
+                with m.if_("x > %d", i):
+                    m.return_("x")
+                m.sep()
+        text = m.render()
+        chunks = list(m.iter_chunks(100))
+        self.assertTrue(len(chunks) > 10)
+        self.assertEqual("".join(chunks), text)
+        f = StringIO()
+        m.render_to(f, chunk_size = 7)
+        self.assertEqual(f.getvalue(), text)
+        self.assertEqual(PythonModule().render(), "\n")
+    
+    def test_compact(self):
+        def build(m):
+            self.gen_class(m, "MyClass", "a", "b")
+            m.comment("hello", "world", sep = True)
+            with m.cython() as cm:
+                with cm.cdef.class_("Spam"):
+                    with cm.method("eggs"):
+                        cm.pass_()
+            return m
+        self.assertEqual(build(PythonModule(compact = True)).render(), build(PythonModule()).render())
+    
+    def test_cache_render(self):
+        calls = []
+        class Counted(str):
+            def __str__(self):
+                calls.append(self)
+                return str.__str__(self)
+        
+        def build(m, count):
+            for i in range(count):
+                with m.def_("f%d" % (i,), "x"):
+                    with m.if_("x"):
+                        m.stmt(Counted("return %d" % (i,)))
+        m = PythonModule(cache_render = True)
+        build(m, 10)
+        with m.class_("Foo"):
+            with m.method("bar"):
+                m.stmt(Counted("return 1"))
+                self.assertEqual(m.render(), m.render())
+                del calls[:]
+                m.render()
+                # only the suites that are still open are re-rendered
+                self.assertEqual(calls, ["return 1"])
+        build(m, 3)
+        expected = PythonModule()
+        build(expected, 10)
+        with expected.class_("Foo"):
+            with expected.method("bar"):
+                expected.stmt("return 1")
+        build(expected, 3)
+        expected = expected.render()
+        self.assertEqual(m.render(), expected)
+        del calls[:]
+        self.assertEqual(m.render(), expected)
+        self.assertEqual(calls, [])
+    
+    def test_dump_only_if_changed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "mod.py")
+            m = PythonModule()
+            self.gen_class(m, "MyClass", "a", "b")
+            self.assertTrue(m.dump(filename, only_if_changed = True))
+            os.utime(filename, (1000, 1000))
+            self.assertFalse(m.dump(filename, only_if_changed = True))
+            self.assertEqual(os.path.getmtime(filename), 1000)
+            m.stmt("x = 5")
+            os.chmod(filename, 0o600)
+            self.assertTrue(m.dump(filename, only_if_changed = True))
+            with open(filename) as f:
+                self.assertEqual(f.read(), m.render())
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+            self.assertEqual(os.listdir(tmpdir), ["mod.py"])
+            # the text is rendered once, whether or not the file has changed
+            calls = []
+            def make_chunks():
+                calls.append(1)
+                return m.iter_chunks()
+            self.assertFalse(dump_chunks(filename, make_chunks, only_if_changed = True))
+            m.stmt("y = 6")
+            self.assertTrue(dump_chunks(filename, make_chunks, only_if_changed = True))
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(os.listdir(tmpdir), ["mod.py"])
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    def test_dump_compressed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            m = PythonModule()
+            self.gen_class(m, "MyClass", "a", "b")
+            text = m.render().encode("utf8")
+            filename = os.path.join(tmpdir, "mod.py.gz")
+            self.assertTrue(m.dump(filename, only_if_changed = True))
+            with gzip.open(filename) as f:
+                self.assertEqual(f.read(), text)
+            self.assertFalse(m.dump(filename, only_if_changed = True))
+            for name, decompress in [("mod.py.xz", lzma.decompress), ("mod.py.bz2", bz2.decompress)]:
+                m.dump(os.path.join(tmpdir, name))
+                with open(os.path.join(tmpdir, name), "rb") as f:
+                    self.assertEqual(decompress(f.read()), text)
+            out = BytesIO()
+            m.dump(out, compression = "zlib")
+            self.assertEqual(zlib.decompress(out.getvalue()), text)
+            self.assertRaises(ValueError, m.dump, out, compression = "rar")
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    def test_expressions(self):
+        a = E("a")
+        self.assertEqual(str((a + 1) * a.x[2] // -a), "(((a + 1) * a.x[2]) // -a)")
+        self.assertEqual(str(E("f")(a % 2, 3 ** a, k = ~a)), "f((a % 2), (3 ** a), k = not a)")
+        self.assertEqual(repr(1 | (a & "s")), "(1 or (a and 's'))")
+        total = E("x")
+        for i in range(100000):
+            total = total + E("y")[i]
+        text = str(total)
+        self.assertTrue(text.startswith("(" * 100000 + "x + y[0]) + y[1])"))
+        self.assertTrue(text.endswith(" + y[99999])"))
+        self.assertIs(str(total), text)
+    
+    def test_interning(self):
+        enable_interning(E)
+        try:
+            self.assertIs(E("x"), E("x"))
+            self.assertIs(E("x")[0] + 1, E("x")[0] + 1)
+            self.assertIsNot(E("x")[0], E("x")[1])
+            big1 = big2 = E("y")
+            for i in range(50):
+                big1 = big1 + E("z")[i]
+                big2 = big2 + E("z")[i]
+            self.assertIs(big1, big2)
+            text = str(big1)
+            self.assertIs(E(text), big1)
+            self.assertEqual(str(big1 * 2), "(%s * 2)" % (text,))
+            # copies aren't the shared empty expression that E.__new__(E) would return
+            self.assertIs(copy.copy(E("zzz")), E("zzz"))
+            self.assertIs(copy.deepcopy(big1), big1)
+            self.assertIs(pickle.loads(pickle.dumps(E("x")[0])), E("x")[0])
+            self.assertEqual(str(E("")), "")
+        finally:
+            disable_interning(E)
+        self.assertIsNot(E("x"), E("x"))
+        self.assertEqual(str(E("x").enable_interning), "x.enable_interning")
+        self.assertEqual(str(E("x")[0]), "x[0]")
+    
+    def test_pickled(self):
+        table = dict((i, "x" * (i % 7)) for i in range(1000))
+        plain = str(P(table))
+        highest = str(P(table, protocol = pickle.HIGHEST_PROTOCOL))
+        compressed = str(P(table, protocol = pickle.HIGHEST_PROTOCOL, compress = True))
+        self.assertTrue(len(compressed) < len(highest) <= len(plain))
+        for text in (plain, highest, compressed):
+            self.assertEqual(eval(text, {"pickle" : pickle, "zlib" : zlib, "base64" : base64}), table)
+    
+    def test_sidecar(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            m = PythonModule()
+            m.sidecar_loader()
+            table = m.sidecar("TABLE", list(range(1000)))
+            blob = m.sidecar("BLOB", b"\x00\x01" * 100, mmap_mode = "r")
+            with m.def_("get", "i"):
+                m.return_(table[E("i")])
+            with m.def_("blob"):
+                m.return_(blob)
+            self.assertTrue(m.dump(os.path.join(tmpdir, "consts.py"), only_if_changed = True))
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["BLOB.bin", "TABLE.pickle", "consts.py"])
+            self.assertFalse(m.dump(os.path.join(tmpdir, "consts.py"), only_if_changed = True))
+            ns = {"__file__" : os.path.join(tmpdir, "consts.py")}
+            with open(ns["__file__"]) as f:
+                exec(f.read(), ns)
+            self.assertEqual(ns["_sidecars"], {})
+            self.assertEqual(ns["get"](17), 17)
+            self.assertEqual(list(ns["_sidecars"]), ["TABLE.pickle"])
+            self.assertEqual(ns["blob"]()[:4], b"\x00\x01\x00\x01")
+            ns["blob"]().close()
+            self.assertRaises(ValueError, m.sidecar, "TABLE", [1, 2])
+            # sidecars are replaced atomically, keeping their mode
+            path = os.path.join(tmpdir, "TABLE.pickle")
+            os.chmod(path, 0o640)
+            m2 = PythonModule()
+            m2.sidecar("TABLE", [3])
+            self.assertTrue(m2.write_sidecars(tmpdir, only_if_changed = True))
+            self.assertEqual(oct(os.stat(path).st_mode & 0o777), oct(0o640))
+            self.assertEqual(sorted(n for n in os.listdir(tmpdir) if n.startswith(".")), [])
+            self.assertRaises(ValueError, m.compile)
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    def test_compile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            m = PythonModule("gen")
+            with m.def_("f", "x"):
+                m.return_(E("x") * 2)
+            code = m.compile()
+            self.assertEqual(code.co_filename, "<gen>")
+            self.assertIs(m.compile(), code)
+            cache_dir = os.path.join(tmpdir, "cache")
+            code = m.compile("gen.py", cache_dir = cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            pycache._code_cache.clear()
+            self.assertEqual(m.compile("gen.py", cache_dir = cache_dir), code)
+            ns = {}
+            exec(code, ns)
+            self.assertEqual(ns["f"](21), 42)
+            
+            filename = os.path.join(tmpdir, "gen.py")
+            self.assertTrue(m.dump(filename, only_if_changed = True, pyc = True))
+            self.assertFalse(m.dump(filename, only_if_changed = True, pyc = True))
+            with open(filename, "rb") as f:
+                source = f.read()
+            with open(importlib.util.cache_from_source(filename), "rb") as f:
+                data = f.read()
+            self.assertEqual(data[4:8], b"\x03\x00\x00\x00")
+            self.assertEqual(data[8:16], importlib.util.source_hash(source))
+            ns = {}
+            exec(marshal.loads(data[16:]), ns)
+            self.assertEqual(ns["f"](4), 8)
+            self.assertRaises(ValueError, m.dump, filename + ".gz", pyc = True)
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    def test_deep_nesting(self):
+        depth = 5000
+        m = PythonModule(indentation = " ")
+        stack = []
+        for i in range(depth):
+            ctx = m.if_("x > {0}", i)
+            ctx.__enter__()
+            stack.append(ctx)
+        m.pass_()
+        while stack:
+            stack.pop().__exit__(None, None, None)
+            m.stmt("y")
+        expected = ["%sif x > %d:" % (" " * i, i) for i in range(depth)]
+        expected.append(" " * depth + "pass")
+        expected.extend(" " * i + "y" for i in reversed(range(depth)))
+        self.assertEqual(m.render(), "\n".join(expected) + "\n")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,112 @@
+from __future__ import with_statement
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from srcgen.python import PythonModule
+from srcgen.split import split_source
+
+
+class TestSplit(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        sys.path.insert(0, self.root)
+    def tearDown(self):
+        sys.path.remove(self.root)
+        for name in list(sys.modules):
+            if name.split(".")[0] == "genpkg":
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def build(self, count):
+        m = PythonModule()
+        m.doc("generated")
+        m.import_("functools")
+        m.stmt("SCALE = 3")
+        with m.class_("Base"):
+            with m.method("scale", "x"):
+                m.return_("x * SCALE")
+        for i in range(count):
+            m.stmt("@functools.lru_cache()")
+            with m.def_("f%d" % (i,), "x"):
+                m.return_("x + %d" % (i,))
+            with m.class_("C%d" % (i,), "Base"):
+                m.stmt("OFFSET = f%d(0)" % (i,))
+        with m.def_("is_even", "n"):
+            m.return_("True if n == 0 else is_odd(n - 1)")
+        with m.def_("is_odd", "n"):
+            m.return_("False if n == 0 else is_even(n - 1)")
+        with m.def_("main"):
+            m.return_("f0(1)")
+        m.stmt("DEFAULT = main()")
+        return m
+
+    def test_split(self):
+        m = self.build(50)
+        init, shards = split_source(m.render(), shard_size = 0, split_side_effects = True)
+        # main and f0 stay in the __init__ (the top-level code needs them)
+        self.assertEqual(len(shards), 50 + 49 + 3)
+        self.assertTrue(init.startswith("'generated'\nimport functools\n"))
+        self.assertIn("def main():", init)
+        self.assertNotIn("def f1(", init)
+        self.assertEqual(shards[0][1], "from . import SCALE\n\nclass Base(object):\n    def scale(self, x):\n        return x * SCALE\n")
+        self.assertEqual(shards[1][1], "from . import Base\nfrom . import f0\n\nclass C0(Base):\n    OFFSET = f0(0)\n")
+
+        self.assertTrue(m.dump_package(os.path.join(self.root, "genpkg"), shard_size = 1000, only_if_changed = True, split_side_effects = True))
+        self.assertFalse(m.dump_package(os.path.join(self.root, "genpkg"), shard_size = 1000, only_if_changed = True, split_side_effects = True))
+        import genpkg
+        self.assertEqual(genpkg.DEFAULT, 1)
+        self.assertEqual([n for n in sys.modules if n.startswith("genpkg.")], [])
+        self.assertEqual(genpkg.f1(1), 2)
+        self.assertEqual([n for n in sys.modules if n.startswith("genpkg.")], ["genpkg._shard0"])
+        self.assertEqual(genpkg.C42().scale(2), 6)
+        self.assertEqual(genpkg.C42.OFFSET, 42)
+        self.assertTrue(genpkg.is_even(10))
+        self.assertIn("f17", dir(genpkg))
+        self.assertIn("f17", genpkg.__all__)
+        from genpkg import f17
+        self.assertEqual(f17(1), 18)
+        self.assertRaises(AttributeError, getattr, genpkg, "f50")
+
+        m = self.build(2)
+        m.dump_package(os.path.join(self.root, "genpkg"), shard_size = 1000, split_side_effects = True)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "genpkg"))), ["__init__.py", "_shard0.py"])
+
+    def test_side_effects(self):
+        m = PythonModule()
+        m.stmt("REG = []")
+        with m.def_("register", "func"):
+            m.stmt("REG.append(func.__name__)")
+            m.return_("func")
+        with m.class_("Meta", "type"):
+            with m.method("__init__", "name", "bases", "ns"):
+                m.stmt("REG.append(name)")
+        with m.class_("Plugin"):
+            with m.classmethod("__init_subclass__", "**kwargs"):
+                m.stmt("REG.append(cls.__name__)")
+        m.stmt("@register")
+        with m.def_("handler"):
+            m.pass_()
+        with m.class_("Tagged", "metaclass = Meta"):
+            m.pass_()
+        with m.class_("Sub", "Plugin"):
+            m.pass_()
+        with m.def_("plain"):
+            m.return_("len(REG)")
+        m.dump_package(os.path.join(self.root, "genpkg"))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "genpkg"))), ["__init__.py", "_shard0.py"])
+        import genpkg
+        self.assertEqual(genpkg.REG, ["handler", "Tagged", "Sub"])
+        self.assertEqual(genpkg.plain(), 3)
+        self.assertEqual([n for n in sys.modules if n.startswith("genpkg.")], ["genpkg._shard0"])
+
+    def test_unsplittable(self):
+        self.assertRaises(ValueError, split_source, "from . import x\n")
+        init, shards = split_source("X = 1\ndef f():\n    global X\n    X = 2\ndef g(): pass\ndef g(): pass\n")
+        self.assertEqual(shards, [])
+        self.assertEqual(init, "X = 1\ndef f():\n    global X\n    X = 2\ndef g(): pass\ndef g(): pass\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+from __future__ import with_statement
+import json
+import shutil
+import tempfile
+import unittest
+from srcgen.python import PythonModule
+from srcgen.html import HtmlDocument
+from srcgen.project import Project
+from srcgen.stats import aggregate
+
+
+def build(m, count):
+    for i in range(count):
+        with m.def_("f%d" % (i,), "x"):
+            with m.if_("x"):
+                m.return_(i)
+    return m
+
+
+class TestStats(unittest.TestCase):
+    def test_module(self):
+        events = []
+        m = PythonModule()
+        st = m.instrument(callback = lambda event, obj, stats: events.append((event, obj)), trace_memory = True)
+        build(m, 10)
+        text = m.render()
+        self.assertEqual(events, [("render_start", m), ("render_end", m)])
+        self.assertEqual(st.lines, text.count("\n"))
+        self.assertEqual(st.output_size, len(text))
+        self.assertEqual(st.suites, 20)
+        self.assertEqual(st.max_depth, 2)
+        self.assertEqual(st.renders, 1)
+        self.assertTrue(st.peak_memory > 0)
+        self.assertEqual(json.loads(st.to_json())["lines"], st.lines)
+        m.uninstrument()
+        m.render()
+        self.assertEqual(st.renders, 1)
+
+    def test_document(self):
+        doc = HtmlDocument()
+        st = doc.instrument()
+        with doc.body():
+            with doc.div():
+                doc.p("hello")
+        text = doc.render()
+        self.assertEqual(st.suites, 4)
+        self.assertEqual(st.max_depth, 4)
+        self.assertEqual(st.output_size, len(text))
+
+    def test_project(self):
+        root = tempfile.mkdtemp()
+        try:
+            proj = Project(root)
+            for i in range(4):
+                proj.add("mod%d.py" % (i,), build(PythonModule(), i + 1)).instrument()
+            proj.add("plain.py", build(PythonModule(), 1))
+            results = proj.dump(workers = 2)
+            total = aggregate(r.stats for r in results)
+            self.assertEqual(total["modules"], 4)
+            self.assertEqual(total["suites"], 2 * (1 + 2 + 3 + 4))
+            self.assertEqual(total["dumps"], 4)
+            self.assertEqual(total["max_depth"], 2)
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    unittest.main()